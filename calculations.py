@@ -8,11 +8,14 @@ Notes on variable names:
     of that show (as seen in the Data class)
 - anime_to_genre: a dictionary of anime title to the list of genres associated with the show (as seen in the Data class)
 - anime_user_map: a dictionary mapping of each anime to a list of user's with reviews on that anime
+- raters: the list of users with reviews on a single anime (as returned by Data.get_raters)
 - user_genre_compatibility: dictionary mapping username to a dictionary with key genre and
     value float representing compatibility (obtained from the user_to_genre_compatibility function)
 """
 from __future__ import annotations
 from python_ta.contracts import check_contracts
+import numpy as np
+from data_class import Data
 
 
 @check_contracts
@@ -68,23 +71,51 @@ def user_to_genre_compatibility(user_to_rating: dict[str, dict[str, float]],
 
 
 @check_contracts
-def anime_to_genre_compatibility(anime: str, genre: str, anime_user_map: dict[str, list[str]],
+def user_to_genre_compatibilities(data: Data, username: str) -> dict[str, float]:
+    """Returns a dictionary mapping each genre in data.genre_names to the compatibility/affinity of the given user to
+    that genre, as calculated by user_to_genre_compatibility.
+
+    Every genre is calculated at once, by checking genre membership against the genre masks of the user's
+    rated anime (looked up together in data.anime_genre_masks).
+
+    Preconditions:
+        - username in data.user_to_rating
+    """
+    ratings = data.user_to_rating[username]
+    rating_values = np.array(list(ratings.values()), dtype=np.float64)
+    anime_ids = np.array([data.anime_index[anime] for anime in ratings], dtype=np.int64)
+    masks = data.anime_genre_masks[anime_ids]
+
+    # has_genre[i, g] is whether the user's i-th rated anime has genre g
+    bits = np.arange(len(data.genre_names), dtype=np.uint64)
+    has_genre = ((masks[:, np.newaxis] >> bits) & np.uint64(1)).astype(np.float64)
+
+    rating_sums = rating_values @ has_genre
+    rating_counts = has_genre.sum(axis=0)
+    compatibilities = np.where(rating_counts > 0, rating_sums / np.maximum(rating_counts, 1), 0.5)
+
+    return dict(zip(data.genre_names, compatibilities.tolist()))
+
+
+@check_contracts
+def anime_to_genre_compatibility(anime: str, genre: str, raters: list[str],
                                  user_genre_compatibility: dict[str, dict[str, float]],
                                  user_to_rating: dict[str, dict[str, float]],
                                  anime_to_genre: dict[str, list[str]]) -> float:
-    """Returns a float representing the compatibility/affinity of a given anime to a given genre.
+    """Returns a float representing the compatibility/affinity of a given anime to a given genre, where raters
+    are the users with reviews on the anime.
 
     Preconditions:
         - anime in anime_to_genre
         - genre in anime_to_genre[anime]
-        - all(anime in user_to_rating[user] for user in user_to_rating)
+        - all(anime in user_to_rating[user] for user in raters)
     """
     compatibility = []
 
-    if anime not in anime_user_map:
+    if not raters:
         return 0.5
 
-    for user in anime_user_map[anime]:
+    for user in raters:
         compatibility.append(user_genre_compatibility[user][genre] * user_to_rating[user][anime])
 
     initial = (sum(compatibility) / len(compatibility)) ** 0.5
@@ -101,6 +132,7 @@ if __name__ == '__main__':
 
     import python_ta
     python_ta.check_all(config={
+        'extra-imports': ['numpy', 'data_class'],
         'max-line-length': 120,
         'disable': ['E9992', 'E9997']
     })
@@ -0,0 +1,531 @@
+"""
+This Python module contains an array-based community detection engine, used to divide the anime graph into
+clusters. It implements the Louvain method over arrays of edges rather than a networkx graph, and returns a partition
+in the same format as community.community_louvain.best_partition.
+
+This file is Copyright (c) 2023 Anubha Joshi, Lisa Ye, Simran Vig, Iris Li
+
+Notes on the method:
+- the graph is given as its weighted adjacency matrix in coordinate form (row, col, val), with both directions of
+    every edge and self loops counted twice (as in the degree of a node); each level of the method converts it once
+    to compressed sparse row form (indptr, indices, weights)
+- in the local moving phase, every node finds the neighbouring community that increases modularity the most at once
+    using array operations; a batch of improving nodes that are not adjacent to each other then moves together, in
+    order of improvement, skipping any node whose move no longer increases modularity after the moves before it
+- connected components never share a community, so they are grouped into blocks of similar size and each block is
+    partitioned in its own worker process; if there are fewer blocks than worker processes (e.g. the anime graph,
+    where every user is linked to every anime), the heaviest block is split into coarse blocks that are partitioned
+    in parallel and then refined together
+"""
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Optional
+import itertools
+import os
+from python_ta.contracts import check_contracts
+import networkx as nx
+import numpy as np
+
+# The smallest increase in modularity of a round of moves for the local moving phase to continue
+MIN_GAIN = 1e-7
+
+
+@check_contracts
+def graph_to_arrays(graph: nx.Graph) -> tuple[list, np.ndarray, np.ndarray, np.ndarray]:
+    """Return the nodes of the given graph along with its weighted adjacency matrix in coordinate form
+    (row, col, val), where row and col index into the returned list of nodes. Edges without a weight have weight 1.
+    """
+    nodes = list(graph.nodes)
+    node_index = {node: i for i, node in enumerate(nodes)}
+    adjacency = list(graph.adjacency())
+
+    # Both directions of every edge come from the adjacency of each of its ends
+    row = np.repeat(np.arange(len(nodes)), [len(neighbours) for _, neighbours in adjacency])
+    col = np.fromiter(map(node_index.__getitem__, itertools.chain.from_iterable(nbrs for _, nbrs in adjacency)),
+                      dtype=np.int64, count=len(row))
+    val = np.fromiter((attributes.get('weight', 1.0) for _, nbrs in adjacency for attributes in nbrs.values()),
+                      dtype=np.float64, count=len(row))
+
+    # A self loop appears once in the adjacency of its node, but counts twice
+    val[row == col] *= 2
+
+    return (nodes, row, col, val)
+
+
+@check_contracts
+def best_partition(graph: nx.Graph, partition: Optional[dict] = None, resolution: float = 1.0,
+                   processes: Optional[int] = None, random_state: Optional[int] = None) -> dict[Any, int]:
+    """Return a partition of the nodes of the given graph into communities, as a dictionary mapping of each node to
+    its community number (numbered from 0), found with the Louvain method.
+
+    If partition is given, the search starts from it (nodes missing from it start in their own community).
+    Blocks of connected components (or coarse blocks of a single large component) are partitioned in up to processes
+    worker processes (by default, one per core); if processes is 1, everything is done in this process.
+
+    Preconditions:
+        - resolution > 0
+        - processes is None or processes > 0
+        - all(weight >= 0 for _, _, weight in graph.edges(data='weight', default=1.0))
+
+    >>> g = nx.Graph([(1, 2), (2, 3), (1, 3), (4, 5), (5, 6), (4, 6), (3, 4)])
+    >>> result = best_partition(g, processes=1, random_state=0)
+    >>> result[1] == result[2] == result[3] and result[4] == result[5] == result[6] and result[1] != result[4]
+    True
+    """
+    nodes, row, col, val = graph_to_arrays(graph)
+
+    if partition is None:
+        initial = np.arange(len(nodes))
+    else:
+        initial = _initial_communities([partition.get(node) for node in nodes])
+
+    communities = partition_arrays(len(nodes), row, col, val, initial, resolution, processes, random_state)
+    return dict(zip(nodes, communities.tolist()))
+
+
+@check_contracts
+def modularity(partition: dict, graph: nx.Graph, resolution: float = 1.0) -> float:
+    """Return the modularity of the given partition of the nodes of the given graph.
+
+    Preconditions:
+        - all(node in partition for node in graph.nodes)
+        - graph.number_of_edges() > 0
+
+    >>> g = nx.Graph([(1, 2), (3, 4)])
+    >>> modularity({1: 0, 2: 0, 3: 1, 4: 1}, g)
+    0.5
+    """
+    nodes, row, col, val = graph_to_arrays(graph)
+    communities = np.array([partition[node] for node in nodes])
+    degrees = np.bincount(row, val, minlength=len(nodes))
+    return _modularity(communities, row, col, val, degrees, val.sum(), resolution)
+
+
+@check_contracts
+def community_degree_totals(graph: nx.Graph, partition: dict[Any, int]) -> np.ndarray:
+    """Return the total weighted degree of the nodes in each community of the given partition, indexed by community
+    number.
+
+    Preconditions:
+        - all(node in partition for node in graph.nodes)
+        - all(community >= 0 for community in partition.values())
+    """
+    communities = np.array([partition[node] for node in graph.nodes], dtype=np.int64)
+    degrees = np.array([degree for _, degree in graph.degree(weight='weight')], dtype=np.float64)
+    return np.bincount(communities, degrees, minlength=max(partition.values(), default=-1) + 1)
+
+
+@check_contracts
+def assign_communities(graph: Any, partition: dict[Any, int], new_nodes: list, totals: np.ndarray,
+                       resolution: float = 1.0) -> list[int]:
+    """Return the community of each of the given new nodes of the graph (a networkx graph or a graph.QueryOverlay),
+    where partition is a partition of the rest of the graph and totals was returned by community_degree_totals for
+    it. Every new node is assigned at once to the neighbouring community that increases modularity the most, without
+    moving any other node.
+
+    A new node with no neighbours in the partition is given a new community of its own.
+
+    Preconditions:
+        - all(node not in partition for node in new_nodes)
+        - all(node in graph.nodes for node in new_nodes)
+
+    >>> g = nx.Graph([(1, 2), (3, 4), ('new', 1), ('new', 2)])
+    >>> base = {1: 0, 2: 0, 3: 1, 4: 1}
+    >>> assign_communities(g, base, ['new'], np.array([2.0, 2.0]))
+    [0]
+    """
+    num_communities = len(totals)
+    weight_to = np.zeros((len(new_nodes), num_communities))
+    degrees = np.zeros(len(new_nodes))
+
+    for i, node in enumerate(new_nodes):
+        for neighbour, attributes in graph[node].items():
+            weight = attributes.get('weight', 1.0)
+            degrees[i] += weight
+            if neighbour in partition:
+                weight_to[i, partition[neighbour]] += weight
+
+    two_m = totals.sum() + 2 * degrees.sum()
+    gains = np.where(weight_to > 0, weight_to - resolution * totals * degrees[:, np.newaxis] / two_m, -np.inf)
+
+    communities = []
+    for i in range(len(new_nodes)):
+        if np.any(weight_to[i] > 0):
+            communities.append(int(np.argmax(gains[i])))
+        else:
+            communities.append(num_communities + i)
+
+    return communities
+
+
+def partition_arrays(num_nodes: int, row: np.ndarray, col: np.ndarray, val: np.ndarray, initial: np.ndarray,
+                     resolution: float = 1.0, processes: Optional[int] = None,
+                     random_state: Optional[int] = None) -> np.ndarray:
+    """Return the community number (numbered from 0) of each of the num_nodes nodes of the graph whose weighted
+    adjacency matrix in coordinate form is (row, col, val), starting from the communities in initial.
+
+    Preconditions:
+        - initial.shape == (num_nodes,)
+        - row, col and val were returned by graph_to_arrays()
+    """
+    two_m = val.sum()
+    communities = initial.copy()
+
+    if num_nodes == 0 or two_m == 0:
+        return _renumber(communities)
+
+    workers = processes or os.cpu_count() or 1
+    degrees = np.bincount(row, val, minlength=num_nodes)
+    rng = np.random.default_rng(random_state)
+    blocks = _component_blocks(num_nodes, row, col, val, workers)
+    split, coarse = 0, []
+
+    if workers > 1 and len(blocks) < workers:
+        # Too few blocks to keep every worker busy (e.g. the graph is one component): split the heaviest block into
+        # coarse blocks, which are partitioned in parallel and then refined together below
+        split = int(np.argmax([degrees[block].sum() for block in blocks]))
+        coarse = _coarse_blocks(blocks[split], degrees, workers - len(blocks) + 1, rng)
+        blocks = blocks[:split] + coarse + blocks[split + 1:]
+
+    seeds = rng.integers(2 ** 32, size=len(blocks) + 1)
+    tasks = [_block_task(block, num_nodes, row, col, val, degrees, communities, two_m, resolution, int(seed))
+             for block, seed in zip(blocks, seeds)]
+
+    if workers == 1 or len(tasks) == 1:
+        results = [_louvain(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_louvain, *zip(*tasks)))
+
+    # Offset each block's community numbers so that communities in different blocks stay separate
+    offset = 0
+    for block, block_communities in zip(blocks, results):
+        communities[block] = block_communities + offset
+        offset += len(block)
+
+    if coarse:
+        # Refine the coarse blocks as a whole, starting from their combined communities
+        block = np.sort(np.concatenate(blocks[split:split + len(coarse)]))
+        task = _block_task(block, num_nodes, row, col, val, degrees, communities, two_m, resolution, int(seeds[-1]))
+        communities[block] = _louvain(*task) + offset
+
+    return _renumber(communities)
+
+
+def _block_task(block: np.ndarray, num_nodes: int, row: np.ndarray, col: np.ndarray, val: np.ndarray,
+                degrees: np.ndarray, communities: np.ndarray, two_m: float, resolution: float, seed: int) -> tuple:
+    """Return the arguments of _louvain for the subgraph induced by the given block of nodes, numbered in the
+    order of block. The degrees (and two_m) stay those of the whole graph.
+    """
+    local_index = np.full(num_nodes, -1)
+    local_index[block] = np.arange(len(block))
+    edges = (local_index[row] >= 0) & (local_index[col] >= 0)
+
+    return (len(block), local_index[row[edges]], local_index[col[edges]], val[edges], degrees[block],
+            communities[block], two_m, resolution, seed)
+
+
+def _louvain(num_nodes: int, row: np.ndarray, col: np.ndarray, val: np.ndarray, degrees: np.ndarray,
+             initial: np.ndarray, two_m: float, resolution: float, seed: int) -> np.ndarray:
+    """Return the community of each node of the given graph found by the Louvain method, where degrees are the
+    weighted degrees of the nodes and two_m is the total weight of the whole graph the given graph is part of.
+    """
+    rng = np.random.default_rng(seed)
+    node_levels = np.arange(num_nodes)
+    communities = _renumber(initial)
+    indptr, indices, weights = _csr(num_nodes, row, col, val)
+
+    while True:
+        level_communities = _renumber(_local_moving(indptr, indices, weights, degrees, two_m, communities,
+                                                    resolution, rng))
+        num_communities = level_communities.max() + 1
+        node_levels = level_communities[node_levels]
+
+        if num_communities == num_nodes:
+            break
+
+        # Aggregate each community into a single node of the next level
+        row = np.repeat(level_communities, np.diff(indptr))
+        col = level_communities[indices]
+        key, inverse = np.unique(row * num_communities + col, return_inverse=True)
+        indptr, indices, weights = _csr(num_communities, key // num_communities, key % num_communities,
+                                        np.bincount(inverse, weights))
+        degrees = np.bincount(level_communities, degrees, minlength=num_communities)
+        num_nodes = num_communities
+        communities = np.arange(num_nodes)
+
+    return _renumber(node_levels)
+
+
+def _csr(num_nodes: int, row: np.ndarray, col: np.ndarray,
+         val: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return the (indptr, indices, weights) compressed sparse row form of the given coordinate form, leaving out
+    self loops (they move with their node, so they never change which move is best).
+    """
+    off_diagonal = row != col
+    row, col, val = row[off_diagonal], col[off_diagonal], val[off_diagonal]
+    order = np.lexsort((col, row))
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(row, minlength=num_nodes))))
+    return (indptr, col[order], val[order])
+
+
+def _local_moving(indptr: np.ndarray, indices: np.ndarray, weights: np.ndarray, degrees: np.ndarray,
+                  two_m: float, communities: np.ndarray, resolution: float, rng: np.random.Generator) -> np.ndarray:
+    """Return the communities of the nodes after rounds of moving nodes to the neighbouring community that
+    increases modularity the most, until a round increases modularity by less than MIN_GAIN.
+
+    Each round moves a batch of nodes that are not adjacent to each other, so the weight each of them has to each
+    community is unaffected by the others' moves.
+    """
+    num_nodes = len(degrees)
+    communities = communities.copy()
+
+    if len(indices) == 0:
+        return communities
+
+    lengths = np.diff(indptr)
+    entry_rows = np.repeat(np.arange(num_nodes), lengths)
+    row_starts = indptr[:-1][lengths > 0]
+    totals = np.bincount(communities, degrees, minlength=num_nodes)
+    scale = resolution * degrees / two_m
+
+    while True:
+        targets, target_weights, own_weights = _best_moves(entry_rows, indices, weights, communities, totals, scale)
+
+        # Gain (up to a constant factor) of each node joining its best neighbouring community instead of staying
+        improvements = target_weights - own_weights - scale * (totals[targets] - totals[communities] + degrees)
+        improving = (targets != communities) & (improvements > 1e-12)
+        if not np.any(improving):
+            break
+
+        # Improving nodes may move unless an improving neighbour takes priority over them: lower degree nodes first
+        # (they disturb the community totals the least), then in random order
+        candidates = np.flatnonzero(improving)
+        priority = np.zeros(num_nodes)
+        priority[candidates[np.lexsort((rng.random(len(candidates)), degrees[candidates]))]] = \
+            np.arange(len(candidates), 0, -1)
+        neighbour_priority = np.zeros(num_nodes)
+        neighbour_priority[lengths > 0] = np.maximum.reduceat(priority[indices], row_starts)
+        candidates = candidates[priority[candidates] > neighbour_priority[candidates]]
+
+        candidates = candidates[np.argsort(-improvements[candidates], kind='stable')]
+        movers, gain = _accept_moves(candidates, communities, targets, improvements, degrees, scale)
+
+        totals -= np.bincount(communities[movers], degrees[movers], minlength=num_nodes)
+        totals += np.bincount(targets[movers], degrees[movers], minlength=num_nodes)
+        communities[movers] = targets[movers]
+
+        if 2 * gain / two_m < MIN_GAIN:
+            break
+
+    return communities
+
+
+def _best_moves(entry_rows: np.ndarray, indices: np.ndarray, weights: np.ndarray, communities: np.ndarray,
+                totals: np.ndarray, scale: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return the best neighbouring community of each node other than its own (or its own community if it has
+    no other), the weight from the node to that community, and the weight from the node to its own community.
+
+    A node's weight to a community of a single node is the weight of one edge, so only the weights to the
+    communities of several nodes need summing; while there are few of those, they are summed into a dense
+    (node, community) table rather than by sorting every edge by community.
+    """
+    num_nodes = len(communities)
+    neighbour_communities = communities[indices]
+    shared = np.flatnonzero(np.bincount(communities, minlength=num_nodes) > 1)
+
+    if num_nodes * len(shared) > 2 * len(indices):
+        return _best_moves_sorted(entry_rows, neighbour_communities, weights, communities, totals, scale)
+
+    nodes = np.arange(num_nodes)
+    targets = communities.copy()
+    target_weights = np.zeros(num_nodes)
+    own_weights = np.zeros(num_nodes)
+    best_gains = np.full(num_nodes, -np.inf)
+
+    column = np.full(num_nodes, -1)
+    column[shared] = np.arange(len(shared))
+    neighbour_columns = column[neighbour_communities]
+    in_shared = neighbour_columns >= 0
+
+    if len(shared) > 0:
+        # Weight from each node to each community of several nodes
+        table = np.bincount(entry_rows[in_shared] * len(shared) + neighbour_columns[in_shared], weights[in_shared],
+                            minlength=num_nodes * len(shared)).reshape(num_nodes, len(shared))
+        own_columns = column[communities]
+        has_own = own_columns >= 0
+        own_weights[has_own] = table[has_own, own_columns[has_own]]
+
+        table_gains = np.where(table > 0, table - scale[:, np.newaxis] * totals[shared], -np.inf)
+        table_gains[has_own, own_columns[has_own]] = -np.inf
+        best_columns = np.argmax(table_gains, axis=1)
+        best_gains = table_gains[nodes, best_columns]
+
+        found = best_gains > -np.inf
+        targets[found] = shared[best_columns[found]]
+        target_weights[found] = table[found, best_columns[found]]
+
+    # Communities of a single node (never the node's own, since there are no self loops)
+    single = np.flatnonzero(~in_shared)
+    if len(single) > 0:
+        rows = entry_rows[single]
+        gains = weights[single] - scale[rows] * totals[neighbour_communities[single]]
+        best = _segment_argmax(gains, rows)
+        best = best[gains[best] > best_gains[rows[best]]]
+
+        targets[rows[best]] = neighbour_communities[single[best]]
+        target_weights[rows[best]] = weights[single[best]]
+
+    return (targets, target_weights, own_weights)
+
+
+def _best_moves_sorted(entry_rows: np.ndarray, neighbour_communities: np.ndarray, weights: np.ndarray,
+                       communities: np.ndarray, totals: np.ndarray,
+                       scale: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return the same as _best_moves, by sorting the edges of each node by the community of the neighbour."""
+    num_nodes = len(communities)
+    key = entry_rows * num_nodes + neighbour_communities
+    order = np.argsort(key, kind='stable')
+    key = key[order]
+
+    # Weight from each node to each of its neighbouring communities, grouped by node
+    group_starts = np.flatnonzero(np.concatenate(([True], key[1:] != key[:-1])))
+    weight_to = np.add.reduceat(weights[order], group_starts)
+    nodes, group_communities = np.divmod(key[group_starts], num_nodes)
+
+    is_own = group_communities == communities[nodes]
+    own_weights = np.zeros(num_nodes)
+    own_weights[nodes[is_own]] = weight_to[is_own]
+
+    gains = np.where(is_own, -np.inf, weight_to - scale[nodes] * totals[group_communities])
+    best = _segment_argmax(gains, nodes)
+    best = best[gains[best] > -np.inf]
+
+    targets = communities.copy()
+    target_weights = np.zeros(num_nodes)
+    targets[nodes[best]] = group_communities[best]
+    target_weights[nodes[best]] = weight_to[best]
+
+    return (targets, target_weights, own_weights)
+
+
+def _segment_argmax(values: np.ndarray, segments: np.ndarray) -> np.ndarray:
+    """Return the index of the first largest value of each run of equal (sorted) segment numbers."""
+    starts = np.flatnonzero(np.concatenate(([True], segments[1:] != segments[:-1])))
+    largest = np.repeat(np.maximum.reduceat(values, starts), np.diff(np.append(starts, len(values))))
+    candidates = np.flatnonzero(values == largest)
+    return candidates[np.concatenate(([True], segments[candidates][1:] != segments[candidates][:-1]))]
+
+
+def _accept_moves(candidates: np.ndarray, communities: np.ndarray, targets: np.ndarray, improvements: np.ndarray,
+                  degrees: np.ndarray, scale: np.ndarray) -> tuple[np.ndarray, float]:
+    """Return the candidates (no two of them adjacent) that still increase modularity when they move in the given
+    order, each after the ones accepted before it, along with the total gain (up to a constant factor).
+
+    Since no two candidates are adjacent, a candidate's gain only changes through the degrees that earlier moves
+    added to or removed from its source and target communities.
+    """
+    sources = communities[candidates].tolist()
+    candidate_targets = targets[candidates].tolist()
+    candidate_gains = improvements[candidates].tolist()
+    candidate_degrees = degrees[candidates].tolist()
+    candidate_scales = scale[candidates].tolist()
+
+    changes = {}
+    accepted = []
+    total_gain = 0.0
+
+    for i in range(len(sources)):
+        source, target = sources[i], candidate_targets[i]
+        gain = candidate_gains[i] - candidate_scales[i] * (changes.get(target, 0.0) - changes.get(source, 0.0))
+
+        if gain > 1e-12:
+            accepted.append(i)
+            total_gain += gain
+            changes[target] = changes.get(target, 0.0) + candidate_degrees[i]
+            changes[source] = changes.get(source, 0.0) - candidate_degrees[i]
+
+    return (candidates[accepted], total_gain)
+
+
+def _modularity(communities: np.ndarray, row: np.ndarray, col: np.ndarray, val: np.ndarray, degrees: np.ndarray,
+                two_m: float, resolution: float) -> float:
+    """Return the modularity of the given communities."""
+    internal = val[communities[row] == communities[col]].sum()
+    totals = np.bincount(communities, degrees)
+    return float(internal / two_m - resolution * np.sum(totals ** 2) / two_m ** 2)
+
+
+def _component_blocks(num_nodes: int, row: np.ndarray, col: np.ndarray, val: np.ndarray,
+                      workers: int) -> list[np.ndarray]:
+    """Return the nodes grouped into blocks of whole connected components, with blocks of roughly equal total
+    edge weight, one (or a few) per worker process.
+    """
+    labels = np.arange(num_nodes)
+    while True:
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, row, labels[col])
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+    components, labels = np.unique(labels, return_inverse=True)
+    component_weights = np.bincount(labels[row], val, minlength=len(components))
+
+    num_blocks = min(len(components), 4 * workers)
+    block_weights = np.zeros(num_blocks)
+    component_blocks = np.zeros(len(components), dtype=np.int64)
+
+    # Greedily give the heaviest remaining component to the lightest block
+    for component in np.argsort(-component_weights, kind='stable'):
+        block = np.argmin(block_weights)
+        component_blocks[component] = block
+        block_weights[block] += component_weights[component]
+
+    node_blocks = component_blocks[labels]
+    return [np.flatnonzero(node_blocks == block) for block in range(num_blocks)
+            if np.any(node_blocks == block)]
+
+
+def _coarse_blocks(nodes: np.ndarray, degrees: np.ndarray, num_blocks: int, rng: np.random.Generator) \
+        -> list[np.ndarray]:
+    """Return the given nodes split at random into num_blocks blocks of roughly equal total degree."""
+    shuffled = rng.permutation(nodes)
+    running = np.cumsum(degrees[shuffled])
+    node_blocks = np.minimum((running - degrees[shuffled]) * num_blocks // running[-1], num_blocks - 1)
+    return [np.sort(shuffled[node_blocks == block]) for block in range(num_blocks) if np.any(node_blocks == block)]
+
+
+def _initial_communities(labels: list) -> np.ndarray:
+    """Return community numbers for the given community labels, where each None label gets a community of its own.
+    """
+    numbers = {}
+    communities = np.empty(len(labels), dtype=np.int64)
+
+    for i, label in enumerate(labels):
+        if label is None:
+            communities[i] = len(labels) + i
+        else:
+            communities[i] = numbers.setdefault(label, len(numbers))
+
+    return _renumber(communities)
+
+
+def _renumber(communities: np.ndarray) -> np.ndarray:
+    """Return the given communities numbered from 0 in order of their first appearance."""
+    _, first, inverse = np.unique(communities, return_index=True, return_inverse=True)
+    order = np.argsort(np.argsort(first, kind='stable'), kind='stable')
+    return order[inverse]
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(verbose=True)
+
+    import python_ta
+    python_ta.check_all(config={
+        'extra-imports': ['numpy', 'networkx', 'concurrent.futures', 'itertools', 'os'],
+        'max-line-length': 120,
+        'disable': ['E9992', 'E9997']
+    })
@@ -4,8 +4,10 @@ from our anime, genre, and user datasets.
 This file is Copyright (c) 2023 Anubha Joshi, Lisa Ye, Simran Vig, Iris Li
 """
 from __future__ import annotations
+from typing import Optional
 import csv
 from python_ta.contracts import check_contracts
+import numpy as np
 
 
 @check_contracts
@@ -19,16 +21,41 @@ class Data:
     - genre_to_anime: a dictionary of genre title to the list of animes associated with it
     - user_to_rating: a dictionary of username to another dictionary of an anime title to the user's rating
     of that show
+    - anime_titles: every anime title, in the order used by the index arrays below
+    - anime_index: the index of each anime title in anime_titles
+    - usernames: every username, in the order used by the index arrays below
+    - rater_counts: the number of users with a rating of each anime in anime_titles
+    - genre_names: every genre, where genre_names[i] is the genre of bit i in the genre masks
+    - anime_genre_masks: a 64-bit mask of the genres of each anime in anime_titles
+    - genre_anime_bitmaps: for each genre in genre_names, a bitmap (packed eight to a byte) of which anime in
+    anime_titles have that genre
 
     Representation Invariants:
     - anime titles, genre names and usernames correspond to those on MyAnimeList
     - all(len(self.anime_to_genre[a] > 0) for a in self.anime_to_genre)
     - all(len(self.genre_to_anime[g] > 0) for g in self.genre_to_anime)
     - all([len(self.user_to_rating[u][r]) == 1 for r in self.user_to_rating[u]] for u in self.user_to_rating)
+    - len(self.rater_counts) == len(self.anime_titles)
+    - len(self.usernames) == len(self.user_to_rating)
+    - len(self.genre_names) <= 64
+    - len(self.anime_genre_masks) == len(self.anime_titles)
     """
     anime_to_genre: dict[str, list[str]]
     genre_to_anime: dict[str, list[str]]
     user_to_rating: dict[str, dict[str, float]]
+    anime_titles: list[str]
+    usernames: list[str]
+    rater_counts: np.ndarray
+    _popularity_ranking: Optional[np.ndarray]
+    anime_index: dict[str, int]
+    _user_index: dict[str, int]
+    _rater_offsets: np.ndarray
+    _raters: np.ndarray
+    _new_raters: dict[int, list[int]]
+    genre_names: list[str]
+    anime_genre_masks: np.ndarray
+    genre_anime_bitmaps: np.ndarray
+    _genre_bits: dict[str, int]
 
     def __init__(self, anime_file='animes.csv', genre_file='genres.csv', user_file='users.csv') -> None:
         """Initializes the Data object with our processed datasets.
@@ -36,36 +63,180 @@ class Data:
         self.anime_to_genre = find_anime_to_genre(anime_file)
         self.genre_to_anime = find_genre_to_anime(genre_file)
         self.user_to_rating = find_user_to_rating(user_file)
+        self._build_anime_user_index()
+        self._build_genre_index()
+
+    def _build_anime_user_index(self) -> None:
+        """Build the inverted index of each anime to the users with a rating of it from self.user_to_rating.
+
+        The users rating the anime at index i are self._raters[self._rater_offsets[i]:self._rater_offsets[i + 1]]
+        (as indices into self.usernames), followed by self._new_raters[i] for ratings added since the index was
+        built.
+        """
+        self.anime_titles = list(self.anime_to_genre)
+        self.usernames = list(self.user_to_rating)
+        self.anime_index = {anime: i for i, anime in enumerate(self.anime_titles)}
+        self._user_index = {user: i for i, user in enumerate(self.usernames)}
+
+        anime_ids = []
+        user_ids = []
+
+        for user_id, user in enumerate(self.usernames):
+            for anime in self.user_to_rating[user]:
+                if anime not in self.anime_index:
+                    self.anime_index[anime] = len(self.anime_titles)
+                    self.anime_titles.append(anime)
+                anime_ids.append(self.anime_index[anime])
+                user_ids.append(user_id)
+
+        anime_ids = np.array(anime_ids, dtype=np.int64)
+        self.rater_counts = np.bincount(anime_ids, minlength=len(self.anime_titles))
+        self._rater_offsets = np.concatenate(([0], np.cumsum(self.rater_counts)))
+        self._raters = np.array(user_ids, dtype=np.int32)[np.argsort(anime_ids, kind='stable')]
+        self._new_raters = {}
+        self._popularity_ranking = None
+
+    def _build_genre_index(self) -> None:
+        """Build the genre mask of each anime and the anime bitmap of each genre from self.anime_to_genre."""
+        self.genre_names = list(self.genre_to_anime)
+        for anime in self.anime_to_genre:
+            for genre in self.anime_to_genre[anime]:
+                if genre not in self.genre_names:
+                    self.genre_names.append(genre)
+        self._genre_bits = {genre: i for i, genre in enumerate(self.genre_names)}
+
+        self.anime_genre_masks = np.zeros(len(self.anime_titles), dtype=np.uint64)
+        for anime in self.anime_to_genre:
+            self.anime_genre_masks[self.anime_index[anime]] = self.genre_mask(self.anime_to_genre[anime])
+
+        bits = np.arange(len(self.genre_names), dtype=np.uint64)[:, np.newaxis]
+        has_genre = (self.anime_genre_masks[np.newaxis, :] >> bits) & np.uint64(1)
+        self.genre_anime_bitmaps = np.packbits(has_genre.astype(bool), axis=1)
+
+    def genre_mask(self, genres: list[str]) -> int:
+        """Return the 64-bit mask with the bits of the given genres set.
+
+        Preconditions:
+            - all(genre in self.genre_names for genre in genres)
+        """
+        mask = 0
+        for genre in genres:
+            mask |= 1 << self._genre_bits[genre]
+        return mask
+
+    def get_anime_genre_mask(self, anime: str) -> int:
+        """Return the genre mask of the given anime (0 if it has no known genres).
+
+        >>> data = Data()
+        >>> data.get_anime_genre_mask('Haikyuu!! Second Season') & data.genre_mask(['Sports']) != 0
+        True
+        """
+        if anime not in self.anime_index:
+            return 0
+        return int(self.anime_genre_masks[self.anime_index[anime]])
+
+    def anime_filter(self, include_genres: Optional[list[str]] = None, exclude_genres: Optional[list[str]] = None,
+                     animes: Optional[list[str]] = None) -> np.ndarray:
+        """Return a boolean array marking which anime in animes (or in self.anime_titles, if animes is None) have
+        every genre in include_genres and no genre in exclude_genres.
+
+        Preconditions:
+            - include_genres is None or all(genre in self.genre_names for genre in include_genres)
+            - exclude_genres is None or all(genre in self.genre_names for genre in exclude_genres)
+            - animes is None or all(anime in self.anime_index for anime in animes)
+
+        >>> data = Data()
+        >>> selected = data.anime_filter(['Sports'], ['Ecchi'])
+        >>> bool(selected[data.anime_titles.index('Haikyuu!! Second Season')])
+        True
+        >>> data.anime_filter(['Sports'], ['Ecchi'], ['Haikyuu!! Second Season', 'One Piece']).tolist()
+        [True, False]
+        """
+        selected = np.full(self.genre_anime_bitmaps.shape[1], 0xFF, dtype=np.uint8)
+
+        for genre in include_genres or []:
+            selected &= self.genre_anime_bitmaps[self._genre_bits[genre]]
+        for genre in exclude_genres or []:
+            selected &= ~self.genre_anime_bitmaps[self._genre_bits[genre]]
+
+        selected = np.unpackbits(selected, count=len(self.anime_titles)).astype(bool)
+
+        if animes is None:
+            return selected
+        return selected[np.array([self.anime_index[anime] for anime in animes], dtype=np.int64)]
+
+    def add_rating(self, user: str, anime: str, rating: float) -> None:
+        """Record the given user's rating of the given anime, keeping the anime to user index consistent.
+
+        Preconditions:
+            - 0.0 <= rating <= 1.0
+        """
+        if user not in self._user_index:
+            self._user_index[user] = len(self.usernames)
+            self.usernames.append(user)
+            self.user_to_rating[user] = {}
+
+        if anime not in self.anime_index:
+            self.anime_index[anime] = len(self.anime_titles)
+            self.anime_titles.append(anime)
+            self.rater_counts = np.append(self.rater_counts, 0)
+            self._rater_offsets = np.append(self._rater_offsets, self._rater_offsets[-1])
+            self.anime_genre_masks = np.append(self.anime_genre_masks, np.uint64(0))
+            if len(self.anime_titles) > 8 * self.genre_anime_bitmaps.shape[1]:
+                empty_column = np.zeros((len(self.genre_names), 1), dtype=np.uint8)
+                self.genre_anime_bitmaps = np.hstack((self.genre_anime_bitmaps, empty_column))
+
+        if anime not in self.user_to_rating[user]:
+            anime_id = self.anime_index[anime]
+            self._new_raters.setdefault(anime_id, []).append(self._user_index[user])
+            self.rater_counts[anime_id] += 1
+            self._popularity_ranking = None
+
+        self.user_to_rating[user][anime] = rating
+
+    def get_raters(self, anime: str) -> list[str]:
+        """Return a list of the users with a rating of the given anime.
+
+        >>> data = Data()
+        >>> 'karthiga' in data.get_raters('One Piece')
+        True
+        """
+        if anime not in self.anime_index:
+            return []
+
+        return self._raters_of(self.anime_index[anime])
+
+    def _raters_of(self, anime_id: int) -> list[str]:
+        """Return a list of the users with a rating of the anime at the given index into self.anime_titles."""
+        user_ids = self._raters[self._rater_offsets[anime_id]:self._rater_offsets[anime_id + 1]].tolist()
+        user_ids.extend(self._new_raters.get(anime_id, []))
+        return [self.usernames[user_id] for user_id in user_ids]
 
     def get_anime_user_dict(self) -> dict[str, list[str]]:
         """Returns a dictionary mapping of each anime to a list of user's with reviews on that anime.
 
+        The mapping is read from the inverted index built at load time rather than recomputed from the ratings.
+
         No preconditions (since it's only self, and any conditions follow as outlined in representation invariants).
         """
-        anime_user_map = {}
-
-        for user in self.user_to_rating:
-            animes = self.user_to_rating[user]
-            for anime in animes:
-                if anime not in anime_user_map:
-                    anime_user_map[anime] = []
-                anime_user_map[anime].append(user)
-
-        return anime_user_map
+        return {self.anime_titles[anime_id]: self._raters_of(anime_id)
+                for anime_id in np.flatnonzero(self.rater_counts).tolist()}
 
     def get_top_n_anime_watched(self, n: int) -> list[str]:
         """Returns a list of anime names, of length n, corresponding to the top anime watched (in order from
         best to least).
 
+        The ranking of every anime by its number of ratings is only recomputed when a rating has been added since
+        it was last computed.
+
         Preconditions:
             - n > 0
         """
-        anime_user_map = self.get_anime_user_dict()
-        anime_watched_map = {anime: len(anime_user_map[anime]) for anime in anime_user_map}
-        anime_ordered = sorted(anime_watched_map.items(), key=lambda x: x[1])
-        top_anime = [tup[0] for tup in anime_ordered[len(anime_ordered) - n:]]
-        top_anime.reverse()
-        return top_anime
+        if self._popularity_ranking is None:
+            ranking = np.argsort(-self.rater_counts, kind='stable')
+            self._popularity_ranking = ranking[self.rater_counts[ranking] > 0]
+
+        return [self.anime_titles[anime_id] for anime_id in self._popularity_ranking[:n]]
 
 
 def find_anime_to_genre(anime_file: str) -> dict[str, list[str]]:
@@ -0,0 +1,228 @@
+"""
+This Python module contains an offline evaluation harness for the Anime Suggestion System. A fraction of the
+ratings of a sample of users is held out, the rest are used as those users' preferences, and the suggestions
+made for them are compared with the held-out ratings.
+
+This file is Copyright (c) 2023 Anubha Joshi, Lisa Ye, Simran Vig, Iris Li
+
+Notes on the metrics (k is the number of suggestions made for each user):
+- a held-out anime is relevant if the user's rating of it is at least relevance_threshold
+- users with no relevant held-out anime (for whom no suggestion can be a hit) are skipped, and every ranking metric
+    below is averaged over the remaining users
+- precision@k: the fraction of the k suggestions that are relevant
+- recall@k: the fraction of the relevant anime that are suggested
+- ndcg@k: the discounted cumulative gain of the suggestions over that of an ideal ordering (binary relevance)
+- coverage: the fraction of all anime that were suggested to at least one user
+"""
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Optional
+import csv
+import math
+import os
+import random
+import tempfile
+import time
+from python_ta.contracts import check_contracts
+import networkx as nx
+import numpy as np
+
+from data_class import Data
+from score_store import ScoreStore
+import community_detection
+import graph
+import matrices
+
+# The shared model of each worker process, set by _init_worker
+_worker_model = {}
+
+
+@check_contracts
+def split_ratings(user_to_rating: dict[str, dict[str, float]], holdout_fraction: float, rng: random.Random) \
+        -> tuple[dict[str, dict[str, float]], dict[str, dict[str, float]]]:
+    """Return a tuple of the kept and the held-out ratings of each user, holding out a random holdout_fraction of
+    each user's ratings (rounded, but always keeping and holding out at least one rating).
+
+    Preconditions:
+        - 0.0 < holdout_fraction < 1.0
+        - all(len(user_to_rating[user]) >= 2 for user in user_to_rating)
+
+    >>> kept, held_out = split_ratings({'Bob': {'AOT': 0.3, 'FMAB': 1.0, 'MP100': 0.5, 'Gintama': 0.9}}, 0.5,
+    ...                                random.Random(0))
+    >>> len(kept['Bob']), len(held_out['Bob'])
+    (2, 2)
+    """
+    kept = {}
+    held_out = {}
+
+    for user in user_to_rating:
+        animes = list(user_to_rating[user])
+        num_held_out = min(max(round(len(animes) * holdout_fraction), 1), len(animes) - 1)
+        held_out_animes = set(rng.sample(animes, num_held_out))
+
+        kept[user] = {anime: user_to_rating[user][anime] for anime in animes if anime not in held_out_animes}
+        held_out[user] = {anime: user_to_rating[user][anime] for anime in animes if anime in held_out_animes}
+
+    return (kept, held_out)
+
+
+@check_contracts
+def ranking_metrics(suggestions: list[str], relevant: set[str], k: int) -> tuple[float, float, float]:
+    """Return the precision@k, recall@k and NDCG@k of the given suggestions (in order from best to least) for the
+    given relevant anime.
+
+    Preconditions:
+        - k > 0
+        - relevant != set()
+
+    >>> ranking_metrics(['AOT', 'FMAB', 'MP100'], {'FMAB', 'Gintama'}, 3)
+    (0.3333333333333333, 0.5, 0.38685280723454163)
+    """
+    hits = [anime in relevant for anime in suggestions[:k]]
+    dcg = sum(1 / math.log2(i + 2) for i in range(len(hits)) if hits[i])
+    ideal_dcg = sum(1 / math.log2(i + 2) for i in range(min(len(relevant), k)))
+
+    return (sum(hits) / k, sum(hits) / len(relevant), dcg / ideal_dcg)
+
+
+@check_contracts
+def evaluate(anime_file: str = 'animes.csv', genre_file: str = 'genres.csv', user_file: str = 'users.csv',
+             num_users: int = 1000, k: int = 10, holdout_fraction: float = 0.2, graph_users: int = 100,
+             relevance_threshold: float = 0.7, processes: Optional[int] = None, seed: int = 0) -> dict[str, float]:
+    """Evaluate the suggestions made for num_users random users of user_file (with at least two ratings each) and
+    return a dictionary of the metrics described at the top of this module, along with the number of evaluated
+    users, the number of them skipped for having no relevant held-out anime, the wall-clock seconds taken to make
+    the suggestions and the number of queries per second.
+
+    The model (genre matrices, graph of graph_users other users, and its partition) is built only from the ratings
+    that are not held out, and the suggestions are made in up to processes worker processes (by default, one per
+    core; if processes is 1, in this process).
+
+    Preconditions:
+        - anime_file, genre_file and user_file are valid
+        - num_users > 0 and k > 0 and graph_users > 0
+        - 0.0 < holdout_fraction < 1.0
+    """
+    rng = random.Random(seed)
+    data = Data(anime_file, genre_file, user_file)
+
+    candidates = [user for user in data.user_to_rating if len(data.user_to_rating[user]) >= 2]
+    eval_users = rng.sample(candidates, min(num_users, len(candidates)))
+    kept, held_out = split_ratings({user: data.user_to_rating[user] for user in eval_users}, holdout_fraction, rng)
+
+    # Build the model from every rating that is not held out
+    training_ratings = dict(data.user_to_rating)
+    training_ratings.update(kept)
+    training_data = _training_data(anime_file, genre_file, training_ratings)
+
+    user_genre = matrices.create_user_genre_matrix(training_data)
+    genre_anime = matrices.create_genre_anime_matrix(training_data, user_genre)
+    anime_list = list(training_data.anime_to_genre)
+
+    eval_user_set = set(eval_users)
+    model_users = [user for user in user_genre if user not in eval_user_set][:graph_users]
+    scores = matrices.mat_mul_map({user: user_genre[user] for user in model_users}, genre_anime, anime_list,
+                                  training_data.user_to_rating, graph_users)
+    anime_graph = graph.populate_graph(scores)
+    partition = community_detection.best_partition(anime_graph, processes=processes, random_state=seed)
+    totals = community_detection.community_degree_totals(anime_graph, partition)
+
+    queries = [(kept[user], k) for user in eval_users]
+    model = (anime_graph, scores, partition, totals, anime_list)
+
+    start = time.perf_counter()
+    if processes == 1:
+        _init_worker(*model)
+        all_suggestions = [_suggest(*query) for query in queries]
+    else:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=model) as executor:
+            all_suggestions = list(executor.map(_suggest, *zip(*queries), chunksize=16))
+    elapsed = time.perf_counter() - start
+
+    precisions, recalls, ndcgs = [], [], []
+    suggested = set()
+    skipped = 0
+
+    for user, suggestions in zip(eval_users, all_suggestions):
+        suggested.update(suggestions)
+        relevant = {anime for anime in held_out[user] if held_out[user][anime] >= relevance_threshold}
+
+        if not relevant:
+            skipped += 1
+            continue
+
+        precision, recall, ndcg = ranking_metrics(suggestions, relevant, k)
+        precisions.append(precision)
+        recalls.append(recall)
+        ndcgs.append(ndcg)
+
+    return {'users': float(len(eval_users)),
+            'skipped': float(skipped),
+            'precision@k': float(np.mean(precisions)) if precisions else 0.0,
+            'recall@k': float(np.mean(recalls)) if recalls else 0.0,
+            'ndcg@k': float(np.mean(ndcgs)) if ndcgs else 0.0,
+            'coverage': len(suggested) / len(anime_list),
+            'seconds': elapsed,
+            'queries/s': len(queries) / elapsed}
+
+
+def print_report(report: dict[str, float]) -> None:
+    """Print the metrics returned by evaluate."""
+    for metric in report:
+        print(metric.ljust(12) + str(round(report[metric], 4)))
+
+
+def _training_data(anime_file: str, genre_file: str, user_to_rating: dict[str, dict[str, float]]) -> Data:
+    """Return a Data object of the given anime and genre files and the given ratings, by writing the ratings to a
+    temporary user file in the format of users.csv.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        user_file = os.path.join(directory, 'users.csv')
+
+        with open(user_file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            for user in user_to_rating:
+                row = [user]
+                for anime in user_to_rating[user]:
+                    row.extend([anime, round(user_to_rating[user][anime] * 10, 6)])
+                writer.writerow(row)
+
+        return Data(anime_file, genre_file, user_file)
+
+
+def _init_worker(anime_graph: nx.Graph, scores: ScoreStore, partition: dict[Any, int], totals: np.ndarray,
+                 anime_list: list[str]) -> None:
+    """Store the shared model used by _suggest in this process."""
+    _worker_model['graph'] = anime_graph
+    _worker_model['scores'] = scores
+    _worker_model['partition'] = partition
+    _worker_model['totals'] = totals
+    _worker_model['anime_list'] = anime_list
+    _worker_model['anime_set'] = set(anime_list)
+
+
+def _suggest(preferences: dict[str, float], n: int) -> list[str]:
+    """Return the n anime suggested for a user with the given preferences by the shared model of this process, in the
+    same way as main.py.
+    """
+    preferences = {anime: preferences[anime] for anime in preferences if anime in _worker_model['anime_set']}
+
+    query_graph = graph.QueryOverlay(_worker_model['graph'], preferences)
+    partition = graph.cluster_query_user(query_graph, _worker_model['partition'], _worker_model['totals'])
+    return graph.get_top_suggestions(_worker_model['scores'], n, preferences, partition)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(verbose=True)
+
+    print_report(evaluate())
+
+    import python_ta
+    python_ta.check_all(config={
+        'extra-imports': ['numpy', 'networkx', 'concurrent.futures', 'csv', 'math', 'os', 'random', 'tempfile',
+                          'time', 'data_class', 'score_store', 'community_detection', 'graph', 'matrices'],
+        'allowed-io': ['print_report', '_training_data'],
+        'max-line-length': 120,
+        'disable': ['E9992', 'E9997']
+    })
@@ -3,28 +3,37 @@ This Python module contains code to generate the graph for the Anime Suggestion
 
 This file is Copyright (c) 2023 Anubha Joshi, Lisa Ye, Simran Vig, Iris Li
 """
-from typing import Any
+from collections import ChainMap
+from collections.abc import Iterator, Mapping
+from typing import Any, Optional, Union
+import csv
+import heapq
 from python_ta.contracts import check_contracts
 import networkx as nx
+import numpy as np
+from score_store import ScoreStore
+import community_detection
+import score_store
 
 
 @check_contracts
-def populate_graph(user_to_anime: dict[str, dict[str, float]]) -> nx.Graph:
-    """Using the given data, populate the anime graph.
+def populate_graph(user_to_anime: ScoreStore) -> nx.Graph:
+    """Using the given scores, populate the anime graph.
 
-    Preconditions:
-        - all(all(0.0 <= user_to_anime[user][anime] <= 1.0 for anime in user_to_anime[user]) for user in user_to_anime)
+    Each user's row of scores is read directly from the store, one user at a time.
     """
     anime_graph = nx.Graph()
 
-    for user in user_to_anime:
+    for anime in user_to_anime.animes:
+        # Assign attribute to node indicating that the node is an anime
+        anime_graph.add_node(anime, type='anime')
+
+    for user in user_to_anime.users:
         # Assign attribute to node indicating that the node is a user
         anime_graph.add_node(user, type='user')
-        for anime in user_to_anime[user]:
-            # Assign attribute to node indicating that the node is an anime
-            anime_graph.add_node(anime, type='anime')
-            # Set the weight of the edges as the rating
-            anime_graph.add_edge(user, anime, weight=user_to_anime[user][anime])
+        # Set the weight of the edges as the (actual or predicted) rating
+        anime_graph.add_weighted_edges_from(zip([user] * len(user_to_anime.animes), user_to_anime.animes,
+                                                user_to_anime.get_row(user).tolist()))
 
     return anime_graph
 
@@ -38,8 +47,118 @@ def add_user_input(graph: nx.Graph, anime_ratings: dict[str, float]) -> None:
         graph.add_edge('program_user', anime, weight=anime_ratings[anime])
 
 
+class _OverlayView(Mapping):
+    """A read-only mapping that looks keys up in extra first and then in base, without copying either. The keys of
+    extra and base must be disjoint.
+    """
+    _base: Mapping
+    _extra: Mapping
+
+    def __init__(self, base: Mapping, extra: Mapping) -> None:
+        self._base = base
+        self._extra = extra
+
+    def __getitem__(self, key: Any) -> Any:
+        if key in self._extra:
+            return self._extra[key]
+        return self._base[key]
+
+    def __iter__(self) -> Iterator:
+        yield from self._base
+        yield from self._extra
+
+    def __len__(self) -> int:
+        return len(self._base) + len(self._extra)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._extra or key in self._base
+
+
 @check_contracts
-def get_users_in_cluster(partition: Any, graph: nx.Graph, cluster_num: int) -> list[str]:
+class QueryOverlay:
+    """
+    A read-only view of a base graph plus one query user and their edges to anime, which are kept in a side
+    structure so that the base graph is never copied or modified. Many overlays can share one base graph at the same
+    time (e.g. one per request, each on its own thread).
+
+    An overlay supports the parts of the networkx graph interface used in this module: overlay.nodes[n],
+    overlay[n1][n2], overlay.neighbors(n), and n in overlay.
+
+    Instance Attributes:
+    - base: the shared graph
+    - user_name: the name of the query user's node
+    - anime_ratings: the weight of the edge from the query user to each anime
+
+    Representation Invariants:
+    - self.user_name not in self.base
+    """
+    base: nx.Graph
+    user_name: str
+    anime_ratings: dict[str, float]
+    nodes: Mapping
+    _user_adjacency: dict[str, dict[str, float]]
+    _anime_adjacency: dict[str, Mapping]
+
+    def __init__(self, base: nx.Graph, anime_ratings: dict[str, float], user_name: str = 'program_user') -> None:
+        """Initialize an overlay of the given user, with the given anime ratings, over the base graph.
+
+        Preconditions:
+            - user_name not in base
+        """
+        self.base = base
+        self.user_name = user_name
+        self.anime_ratings = anime_ratings
+
+        extra_nodes = {user_name: {'type': 'user'}}
+        for anime in anime_ratings:
+            if anime not in base:
+                extra_nodes[anime] = {'type': 'anime'}
+        self.nodes = _OverlayView(base.nodes, extra_nodes)
+
+        # The adjacencies that differ from the base graph are built once, here, rather than on every lookup
+        self._user_adjacency = {anime: {'weight': anime_ratings[anime]} for anime in anime_ratings}
+        self._anime_adjacency = {}
+        for anime in anime_ratings:
+            user_edge = {user_name: self._user_adjacency[anime]}
+            self._anime_adjacency[anime] = _OverlayView(base.adj[anime], user_edge) if anime in base else user_edge
+
+    def __getitem__(self, n: Any) -> Mapping:
+        """Return a mapping of each neighbour of n to the attributes of its edge with n."""
+        if n == self.user_name:
+            return self._user_adjacency
+        if n in self._anime_adjacency:
+            return self._anime_adjacency[n]
+        return self.base.adj[n]
+
+    def __contains__(self, n: Any) -> bool:
+        return n in self.nodes
+
+    def __iter__(self) -> Iterator:
+        return iter(self.nodes)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def neighbors(self, n: Any) -> Iterator:
+        """Return an iterator over the neighbours of n."""
+        return iter(self[n])
+
+
+@check_contracts
+def cluster_query_user(overlay: QueryOverlay, partition: dict[Any, int], totals: np.ndarray) -> Mapping:
+    """Return a view of the given partition of the base graph with the overlay's query user added to the cluster
+    that increases modularity the most. Neither the partition nor the base graph is modified.
+
+    Preconditions:
+        - all(node in partition for node in overlay.base.nodes)
+        - totals was returned by community_detection.community_degree_totals(overlay.base, partition)
+    """
+    cluster_num = community_detection.assign_communities(overlay, partition, [overlay.user_name], totals)[0]
+    return ChainMap({overlay.user_name: cluster_num}, partition)
+
+
+@check_contracts
+def get_users_in_cluster(partition: Any, graph: Union[nx.Graph, QueryOverlay], cluster_num: int) -> list[str]:
     """Return a list of all the users in the same cluster as the program user.
 
     Preconditions:
@@ -53,7 +172,7 @@ def get_users_in_cluster(partition: Any, graph: nx.Graph, cluster_num: int) -> l
 
 
 @check_contracts
-def get_node_type(graph: nx.Graph, n: str) -> str:
+def get_node_type(graph: Union[nx.Graph, QueryOverlay], n: str) -> str:
     """Return the type of the given node n.
 
     Preconditions:
@@ -63,60 +182,137 @@ def get_node_type(graph: nx.Graph, n: str) -> str:
 
 
 @check_contracts
-def get_avg_weight_map(graph: nx.Graph, anime_list: list[str], preferences: dict[str, float],
-                       cluster_partition: Any) -> dict[str, float]:
+def get_avg_weight_map(scores: ScoreStore, anime_list: list[str], preferences: dict[str, float],
+                       cluster_partition: Any, user_name: str = 'program_user') -> dict[str, float]:
     """Return the predicted anime ratings for the user by averaging the ratings of other users' ratings in the same
     cluster.
 
+    The ratings of the other users are read from their rows of the given scores (the store the graph was populated
+    from), rather than from the edges of the graph. The user counts towards the size of the cluster. Only the anime
+    in anime_list that the user has not rated in preferences are predicted, so preferences may include anime that
+    are not in anime_list (e.g. anime removed by a genre filter).
+
     Preconditions:
-        - all(anime in anime_list for anime in preferences)
+        - all(anime in scores.animes for anime in anime_list)
+        - all(user in cluster_partition for user in scores.users)
+        - user_name in cluster_partition
+
+    >>> store = ScoreStore(['Bob', 'Ann'], ['AOT', 'FMAB', 'MP100'])
+    >>> store.set_row('Bob', np.array([0.25, 0.5, 1.0]), np.array([True, False, False]))
+    >>> store.set_row('Ann', np.array([0.5, 1.0, 0.5]), np.array([True, True, False]))
+    >>> get_avg_weight_map(store, ['AOT', 'FMAB', 'MP100'], {'AOT': 0.5}, {'Bob': 0, 'Ann': 0, 'program_user': 0})
+    {'FMAB': 0.5, 'MP100': 0.5}
+    >>> get_avg_weight_map(store, ['FMAB'], {'AOT': 0.5}, {'Bob': 0, 'Ann': 0, 'program_user': 0})
+    {'FMAB': 0.5}
     """
-    cluster_num = cluster_partition['program_user']
-    same_cluster = get_users_in_cluster(cluster_partition, graph, cluster_num)
+    cluster_num = cluster_partition[user_name]
+    same_cluster = [user for user in scores.users if cluster_partition[user] == cluster_num]
+
+    averages = scores.sum_rows(same_cluster) / (len(same_cluster) + 1)
+    anime_avg = dict(zip(scores.animes, averages.tolist()))
 
-    anime_weight_avg = {}
+    return {anime: anime_avg[anime] for anime in anime_list if anime not in preferences}
 
-    for anime in anime_list:
-        if anime in preferences:  # Check whether this anime already has a rating from the user
-            continue
 
-        avg_weight = 0
-        for username in graph.neighbors(anime):
-            if username == 'program_user' or cluster_partition[username] != cluster_num:
-                continue
-            avg_weight += get_edge_weight(graph, username, anime)
-        avg_weight /= len(same_cluster)
-        anime_weight_avg[anime] = avg_weight
+@check_contracts
+def get_top_suggestions(scores: ScoreStore, n: int, preferences: dict[str, float], cluster_partition: Any,
+                        anime_mask: Optional[np.ndarray] = None, user_name: str = 'program_user') -> list[str]:
+    """Return a list of the (at most) n anime with the highest predicted rating for the user, as calculated by
+    get_avg_weight_map, in order from best to least.
 
-    return anime_weight_avg
+    The anime the user has rated in preferences are skipped, and if anime_mask is given, only the anime of
+    scores.animes marked in it are considered (e.g. a mask from Data.anime_filter for genre-filtered suggestions).
+
+    Preconditions:
+        - n > 0
+        - anime_mask is None or anime_mask.shape == (len(scores.animes),)
+        - all(user in cluster_partition for user in scores.users)
+        - user_name in cluster_partition
+
+    >>> store = ScoreStore(['Bob', 'Ann'], ['AOT', 'FMAB', 'MP100'])
+    >>> store.set_row('Bob', np.array([0.25, 0.5, 1.0]), np.array([True, False, False]))
+    >>> store.set_row('Ann', np.array([0.5, 1.0, 0.75]), np.array([True, True, False]))
+    >>> get_top_suggestions(store, 5, {'AOT': 0.5}, {'Bob': 0, 'Ann': 0, 'program_user': 0})
+    ['MP100', 'FMAB']
+    >>> get_top_suggestions(store, 5, {'AOT': 0.5}, {'Bob': 0, 'Ann': 0, 'program_user': 0},
+    ...                     np.array([True, True, False]))
+    ['FMAB']
+    """
+    cluster_num = cluster_partition[user_name]
+    same_cluster = [user for user in scores.users if cluster_partition[user] == cluster_num]
+
+    selected = np.array([anime not in preferences for anime in scores.animes], dtype=bool)
+    if anime_mask is not None:
+        selected &= anime_mask
+
+    # Every average has the same denominator, so the anime are ranked by their total score in the cluster
+    top = score_store.top_n_indices(scores.sum_rows(same_cluster), n, selected)
+    return [scores.animes[i] for i in top]
 
 
 @check_contracts
-def sub_cluster(graph: nx.Graph, same_cluster_users: list[str], suggested_anime: list[str]) -> nx.Graph:
-    """Return the cluster that the user is part of with only the suggested anime.
+def sub_cluster(graph: nx.Graph, same_cluster_users: list[str], suggested_anime: list[str],
+                max_users: int = 50) -> nx.Graph:
+    """Return a read-only view of the cluster that the user is part of with only the suggested anime.
+
+    No nodes or edges are copied: the returned graph is a view over the given graph. At most max_users users are
+    kept, choosing the ones with the highest total edge weight into the suggested anime (ties are broken by
+    degree into the suggestions).
 
     Preconditions:
         - all(user in graph.nodes for user in same_cluster_users)
         - all(anime in graph.nodes for anime in suggested_anime)
+        - max_users > 0
+    """
+    suggested = set(suggested_anime)
+
+    sampled_users = heapq.nlargest(max_users,
+                                   (username for username in same_cluster_users if username != 'program_user'),
+                                   key=lambda username: _cluster_user_score(graph, username, suggested))
+
+    return graph.subgraph(sampled_users + suggested_anime)
+
+
+def _cluster_user_score(graph: nx.Graph, username: str, suggested: set[str]) -> tuple[float, int]:
+    """Return the total edge weight and the degree of the given user into the suggested anime.
+
+    Only the edges to the suggested anime are looked up, rather than every neighbour of the user.
     """
-    sub_graph = nx.Graph()
+    total_weight = 0.0
+    degree = 0
+    neighbours = graph[username]
 
-    for anime in suggested_anime:
-        sub_graph.add_node(anime, type='anime')
+    for anime in suggested:
+        edge = neighbours.get(anime)
+        if edge is not None:
+            total_weight += edge['weight']
+            degree += 1
 
-    for username in same_cluster_users:
-        if username == 'program_user':
-            continue
+    return (total_weight, degree)
 
-        sub_graph.add_node(username, type='user')
-        for anime in suggested_anime:
-            sub_graph.add_edge(username, anime, weight=get_edge_weight(graph, username, anime))
 
-    return sub_graph
+@check_contracts
+def export_sub_cluster(sub_graph: nx.Graph, file_name: str) -> None:
+    """Write the edges of the given sub cluster to file_name as a compact edge list, so that it can be rendered
+    separately. Each row of the csv file has the following format:
+    <username>, <anime>, <weight>
+
+    Weights are rounded to 4 decimal places.
+
+    Preconditions:
+        - file_name is a valid name for a csv file
+        - len(nx.get_node_attributes(sub_graph, 'type')) != 0
+    """
+    with open(file_name, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for n1, n2, weight in sub_graph.edges(data='weight'):
+            if get_node_type(sub_graph, n1) == 'anime':
+                n1, n2 = n2, n1
+            writer.writerow([n1, n2, round(weight, 4)])
 
 
 @check_contracts
-def get_edge_weight(graph: nx.Graph, n1: str, n2: str) -> float:
+def get_edge_weight(graph: Union[nx.Graph, QueryOverlay], n1: str, n2: str) -> float:
     """Return the weight of the edge between the given nodes in the graph.
 
     Preconditions:
@@ -126,11 +322,14 @@ def get_edge_weight(graph: nx.Graph, n1: str, n2: str) -> float:
 
 
 if __name__ == '__main__':
+    import doctest
+    doctest.testmod(verbose=True)
+
     import python_ta
 
     python_ta.check_all(config={
-        'extra-imports': [],
-        'allowed-io': [],
+        'extra-imports': ['numpy', 'score_store', 'community_detection'],
+        'allowed-io': ['export_sub_cluster'],
         'max-line-length': 120,
         'disable': ['E9999']
     })
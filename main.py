@@ -3,17 +3,15 @@ This is the main module for the Anime Suggestion System.
 
 This file is Copyright (c) 2023 Anubha Joshi, Lisa Ye, Simran Vig, Iris Li
 """
-from typing import Any
+from typing import Any, Optional
 from python_ta.contracts import check_contracts
 
 from CourseProject import visualize
 from data_class import Data
-import matrices
+from score_store import ScoreStore
 import graph
-import networkx as nx
-from community import community_louvain
-import pickle
-import extract_raw
+import community_detection
+import pipeline
 from visualize import visualize_and_display
 
 
@@ -54,9 +52,25 @@ def get_num_suggestions() -> int:
 
 
 @check_contracts
-def get_anime_suggestions(data: Data, anime_graph: nx.Graph, partition: Any, preferences: dict[str, float],
-                          n: int) -> list[str]:
-    """Given the graph and user preferences, print and return the suggested anime for the user."""
+def get_anime_suggestions(data: Data, scores: ScoreStore, partition: Any, preferences: dict[str, float], n: int,
+                          include_genres: Optional[list[str]] = None,
+                          exclude_genres: Optional[list[str]] = None) -> list[str]:
+    """Given the scores the graph was populated from, the partition with the user's cluster and the user
+    preferences, print and return the suggested anime for the user.
+
+    Only anime with every genre in include_genres and no genre in exclude_genres are suggested. The user's
+    preferences for anime that do not pass the filter are ignored.
+
+    >>> import numpy as np
+    >>> data = Data()
+    >>> scores = ScoreStore(['Bob', 'Ann'], ['Shingeki no Kyojin', 'Haikyuu!! Second Season', 'One Piece',
+    ...                                      'Kuroko no Basket', 'Slam Dunk'])
+    >>> scores.set_row('Bob', np.array([0.9, 0.8, 0.6, 0.7, 0.4]), np.array([True, True, True, False, False]))
+    >>> scores.set_row('Ann', np.array([0.8, 0.9, 0.5, 0.6, 0.5]), np.array([True, True, False, True, False]))
+    >>> preferences = {'Shingeki no Kyojin': 1.0, 'Haikyuu!! Second Season': 0.8, 'One Piece': 0.5}
+    >>> get_anime_suggestions(data, scores, {'Bob': 0, 'Ann': 0, 'program_user': 0}, preferences, 5, ['Sports'])
+    ['Kuroko no Basket', 'Slam Dunk']
+    """
     # same_cluster = [key for key in partition
     #                 if partition[key] == partition['program_user']
     #                 and anime_graph.nodes[key]['type'] == 'user']
@@ -74,37 +88,18 @@ def get_anime_suggestions(data: Data, anime_graph: nx.Graph, partition: Any, pre
     #     avg_weight /= len(same_cluster)
     #     anime_weight_avg[anime] = avg_weight
 
-    anime_weight_avg = graph.get_avg_weight_map(anime_graph, list(data.anime_to_genre.keys()), preferences, partition)
-
-    sorted_weight = [k for k, v in sorted(anime_weight_avg.items(), key=lambda item: item[1])]
-    n = min(n, len(sorted_weight))
-    top_suggestions = sorted_weight[-n:]
-    top_suggestions.reverse()
-    return top_suggestions
+    selected = data.anime_filter(include_genres, exclude_genres, scores.animes)
+    return graph.get_top_suggestions(scores, n, preferences, partition, selected)
 
 
 if __name__ == '__main__':
 
-    #If generating csv directly from kaggle file, uncomment the following line:
-    extract_raw.extract_data()
-
-    #Code for populating the Data class attributes for use, can uncomment instead of pickle
-    #data = Data('animes.csv', 'genres.csv', 'users.csv')
-    with open(r"program_data.pkl", 'rb') as f:
-        data = pickle.load(f)
-
-    # Code for the matrix multiplication (not needed since we already generated graph)
-    # Can uncomment the code below to use instead of using the pickle files
-    # (Uncomment the code opening the pickle files)
-    # user_genre = matrices.create_user_genre_matrix(data)
-    # genre_anime = matrices.create_genre_anime_matrix(data, user_genre)
-    # user_to_anime = matrices.mat_mul_map(user_genre, genre_anime,
-    #                                      list(data.anime_to_genre.keys()),
-    #                                      data.user_to_rating, 100)
-    # anime_graph = graph.populate_graph(user_to_anime)
-    #
-    with open(r"program_graph.pkl", 'rb') as f:
-        anime_graph = pickle.load(f)
+    # Build (or load from .build_cache) the data, scores, graph and clusters. Each stage, from extracting the kaggle
+    # files to dividing the graph into clusters, is only recomputed when its inputs have changed. The graph is used to
+    # cluster the user, and the suggestions are scored from the scores
+    data, scores, anime_graph, base_partition = pipeline.build()
+
+    cluster_totals = community_detection.community_degree_totals(anime_graph, base_partition)
 
     # Ask the user for their anime preferences
     # Uncomment the code below if using the pre-built preferences
@@ -138,24 +133,26 @@ if __name__ == '__main__':
     #                     'Shingeki no Kyojin The Final Season Part 2': 0.55, 'Boku no Hero Academia': 0.4,
     #                     'Death Parade': 0.3}
 
-    graph.add_user_input(anime_graph, user_preferences)
-
-    partition = community_louvain.best_partition(anime_graph)  # Divide the graph into clusters
+    # Add the user to a view over the graph (the graph itself is left unchanged)
+    query_graph = graph.QueryOverlay(anime_graph, user_preferences)
+    partition = graph.cluster_query_user(query_graph, base_partition, cluster_totals)
 
     cluster_num = partition['program_user']
-    same_cluster = graph.get_users_in_cluster(partition, anime_graph, cluster_num)
+    same_cluster = graph.get_users_in_cluster(partition, query_graph, cluster_num)
 
     # anime_weight_avg = graph.get_avg_weight_map(anime_graph, list(data.anime_to_genre.keys()),
     #                                             partition, cluster_num)
     # # Ask the user for how many anime suggestions they would like
     num_suggestions = get_num_suggestions()
 
-    top_suggestions = get_anime_suggestions(data, anime_graph, partition, user_preferences, int(num_suggestions))
+    top_suggestions = get_anime_suggestions(data, scores, partition, user_preferences, int(num_suggestions))
     print('Top Suggestions for you:')
     for i in range(0, len(top_suggestions)):
         print(str(i+1) + ') '+top_suggestions[i])
 
-    sub_graph = graph.sub_cluster(anime_graph, same_cluster, top_suggestions)
+    # The query user is only in the overlay, so the sub-cluster is taken from the other users of the cluster
+    sub_graph = graph.sub_cluster(anime_graph, [user for user in same_cluster if user != query_graph.user_name],
+                                  top_suggestions)
 
     visualize.visualize_and_display(sub_graph)
 
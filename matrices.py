@@ -4,9 +4,14 @@ the appropriate weights in the final graph.
 
 This file is Copyright (c) 2023 Anubha Joshi, Lisa Ye, Simran Vig, Iris Li
 """
+from typing import Optional
+import hashlib
+import json
 
 import calculations
 from data_class import Data
+from score_store import ScoreStore
+import numpy as np
 from python_ta.contracts import check_contracts
 import python_ta
 import doctest
@@ -24,12 +29,9 @@ def create_user_genre_matrix(data: Data) -> dict[str, dict[str, float]]:
     user_genre_compat_map = {}
 
     for user in data.user_to_rating:
-        user_genre_compat_map[user] = {}
+        compat = calculations.user_to_genre_compatibilities(data, user)
 
-        for genre in data.genre_to_anime:
-            compat = calculations.user_to_genre_compatibility(data.user_to_rating, data.anime_to_genre, genre, user)
-
-            user_genre_compat_map[user][genre] = compat
+        user_genre_compat_map[user] = {genre: compat[genre] for genre in data.genre_to_anime}
 
     return user_genre_compat_map
 
@@ -45,88 +47,114 @@ def create_genre_anime_matrix(data: Data, user_genre_compat_map: dict[str, dict[
         - user_genre_compat_map was generated by the function create_user_genre_matrix()
     """
 
-    genre_anime_map = {}
-    genre_count = 1
-
-    anime_user_dict = data.get_anime_user_dict()
-
-    for genre in data.genre_to_anime:
+    genre_anime_map = {genre: {} for genre in data.genre_to_anime}
+    anime_count = 1
 
-        print('Loaded for ' + str(genre_count) + ' / ' + str(len(data.genre_to_anime)) + ' genres')
+    # The raters of each anime are read from the index once and shared by every genre
+    for anime in data.anime_to_genre:
+        raters = data.get_raters(anime)
 
-        genre_anime_map[genre] = {}
-
-        for anime in data.anime_to_genre:
-            compat = calculations.anime_to_genre_compatibility(anime, genre, anime_user_dict,
+        for genre in data.genre_to_anime:
+            compat = calculations.anime_to_genre_compatibility(anime, genre, raters,
                                                                user_genre_compat_map, data.user_to_rating,
                                                                data.anime_to_genre)
 
             genre_anime_map[genre][anime] = compat
 
-        genre_count += 1
+        if anime_count % 1000 == 0 or anime_count == len(data.anime_to_genre):
+            print('Loaded for ' + str(anime_count) + ' / ' + str(len(data.anime_to_genre)) + ' animes')
+
+        anime_count += 1
 
     return genre_anime_map
 
 
 @check_contracts
 def mat_mul_map(user_genre_map: dict[str, dict[str, float]], genre_anime_map: dict[str, dict[str, float]],
-                anime_list: list[str], user_anime_rating: dict[str, dict[str, float]], user_limit: int) \
-        -> dict[str, dict[str, float]]:
+                anime_list: list[str], user_anime_rating: dict[str, dict[str, float]], user_limit: int,
+                dtype: str = 'float32', file_name: Optional[str] = None, block_size: int = 256) -> ScoreStore:
     """
     Takes the dictionary mapping(s) of user to genre compaibility and genre to anime compatibility, along with the list
-    of all animes, and dictionary mapping of user rating for each anime and returns a dictionary mapping
-    of each user up to user_limit number of users to either their direct rating for the anime or the
-    of each user up to user_limit number of users to either their direct rating for the anime or the
+    of all animes, and dictionary mapping of user rating for each anime and returns a ScoreStore holding, for
+    each user up to user_limit number of users, either their direct rating for the anime or the
     predicted score calculated by matrix multiplication.
 
+    The scores are kept in the given dtype (see score_store.QUANTISATION_ERROR for the error of each dtype), and
+    direct ratings are marked as rated in the returned store.
+
+    The scores are computed block_size users at a time. If file_name is given, each block is written to a
+    memory-mapped store at file_name and checkpointed, so the memory used is bounded by block_size rather than the
+    number of users, and a build that was killed resumes from its last completed block. A hash of the inputs is kept
+    with the checkpoint, so a store computed from different inputs is computed again rather than resumed.
+
     Preconditions:
         - user_genre_map was returned by create_user_genre_matrix()
         - genre_anime_map was returned by create_genre_anime_matrix()
         - all(user in user_anime_rating for user in user_genre_map)
         - all({genre in user_genre_map[user] for genre in genre_anime_map} for user in user_genre_map)
         - all({anime in genre_anime_map[genre] for anime in anime_list} for genre in genre_anime_map)
+        - dtype in score_store.QUANTISATION_ERROR
+        - block_size > 0
     """
+    genres = list(genre_anime_map)
+    users = list(user_genre_map)[:user_limit]
+    anime_index = {anime: i for i, anime in enumerate(anime_list)}
 
-    mat_mul = {}
-
-    user_count = 1
+    # genres x animes matrix of compatibilities, shared by every block of users, and users x genres matrix
+    genre_anime = np.array([[genre_anime_map[genre][anime] for anime in anime_list] for genre in genres])
+    user_genre = np.array([[user_genre_map[user][genre] for genre in genres] for user in users])
 
-    for user in user_genre_map:
-        if user_count > user_limit:
-            break
-        mat_mul[user] = {}
+    inputs_hash = ''
+    if file_name is not None:
+        inputs_hash = _hash_inputs(genres, genre_anime, user_genre, [user_anime_rating[user] for user in users])
 
-        for anime in anime_list:
+    mat_mul = ScoreStore(users, anime_list, dtype, file_name, inputs_hash=inputs_hash)
 
-            sum_score = 0
+    for start in range(mat_mul.rows_done, len(users), block_size):
+        block_users = users[start:start + block_size]
 
-            if anime in user_anime_rating[user]:
-                mat_mul[user][anime] = user_anime_rating[user][anime]
-                continue
+        scores = (user_genre[start:start + block_size] @ genre_anime) / len(genres)
+        rated = np.zeros(scores.shape, dtype=bool)
 
-            for genre in genre_anime_map:
-                sum_score += (user_genre_map[user][genre] * genre_anime_map[genre][anime])
+        for row, user in enumerate(block_users):
+            for anime in user_anime_rating[user]:
+                if anime in anime_index:
+                    scores[row, anime_index[anime]] = user_anime_rating[user][anime]
+                    rated[row, anime_index[anime]] = True
 
-            sum_score /= len(genre_anime_map)
-            mat_mul[user][anime] = sum_score
+        mat_mul.set_rows(start, scores, rated)
+        mat_mul.checkpoint(start + len(block_users))
 
-        print('Loaded for ' + str(user_count) + ' / ' + str(user_limit) +
+        print('Loaded for ' + str(start + len(block_users)) + ' / ' + str(len(users)) +
               ' users')
-        user_count += 1
 
     return mat_mul
 
 
+def _hash_inputs(genres: list[str], genre_anime: np.ndarray, user_genre: np.ndarray,
+                 ratings: list[dict[str, float]]) -> str:
+    """Return a hash of the inputs of mat_mul_map: the genre order, the genre x anime and user x genre matrices,
+    and the ratings of each user.
+    """
+    inputs_hash = hashlib.sha256(json.dumps(genres).encode())
+    inputs_hash.update(genre_anime.tobytes())
+    inputs_hash.update(user_genre.tobytes())
+    inputs_hash.update(json.dumps(ratings, sort_keys=True).encode())
+    return inputs_hash.hexdigest()
+
+
 if __name__ == '__main__':
     data1 = Data()
     user_genre = create_user_genre_matrix(data1)
     genre_anime = create_genre_anime_matrix(data1, user_genre)
     mat_mul_m = mat_mul_map(user_genre, genre_anime, list(data1.anime_to_genre.keys()),
                           data1.user_to_rating, 100)
+    print('Score store size: ' + str(mat_mul_m.nbytes()) + ' bytes')
 
     doctest.testmod(verbose=True)
 
     python_ta.check_all(config={
+        'extra-imports': ['numpy', 'score_store', 'hashlib', 'json'],
         'max-line-length': 120,
         'disable': ['E9992', 'E9997']
     })
@@ -0,0 +1,260 @@
+"""
+This Python module contains the build pipeline of the Anime Suggestion System, which turns the raw datasets into the
+scores, graph and partition used to suggest anime.
+
+This file is Copyright (c) 2023 Anubha Joshi, Lisa Ye, Simran Vig, Iris Li
+
+Notes on the pipeline:
+- the stages are, in order: extract (Kaggle files -> animes.csv, genres.csv, users.csv), data (the Data object),
+    user_genre, genre_anime, scores (the ScoreStore of mat_mul_map), graph, and partition
+- the output of each stage is cached in cache_dir under a key that hashes the contents of its input files, its
+    parameters, the source files of the modules it runs (see _STAGE_MODULES) and the keys of the stages it depends
+    on, so a stage is only recomputed when something it depends on, including its code, has changed
+- when a stage is recomputed, the files cached for it under other keys are deleted
+- the cached scores are only used if the store files exist and every row has been written, so a build killed while
+    computing the scores (or a deleted .bin file) resumes or recomputes the scores rather than failing to open them
+- stages are only loaded when a later stage needs them, so with unchanged inputs a build just loads the cached data,
+    graph and partition, and memory-maps the scores (whose rows are only read when they are used)
+- the hash of each input file is remembered along with its size and modification time, so an unchanged file is not
+    read again
+"""
+from __future__ import annotations
+from typing import Any, Callable, Optional
+import hashlib
+import json
+import os
+import pickle
+from python_ta.contracts import check_contracts
+import networkx as nx
+
+from data_class import Data
+from score_store import ScoreStore
+import calculations
+import community_detection
+import data_class
+import extract_raw
+import graph
+import matrices
+import score_store
+
+# The modules whose code each stage runs, so that a stage is recomputed when that code changes
+_STAGE_MODULES = {
+    'extract': [extract_raw],
+    'data': [data_class],
+    'user_genre': [matrices, calculations],
+    'genre_anime': [matrices, calculations],
+    'scores': [matrices, score_store],
+    'graph': [graph],
+    'partition': [community_detection]
+}
+
+
+@check_contracts
+def build(anime_kaggle_file: str = 'anime_kaggle.csv', user_kaggle_file: str = 'UserAnimeList.csv',
+          anime_file: str = 'animes.csv', genre_file: str = 'genres.csv', user_file: str = 'users.csv',
+          user_limit: int = 100, dtype: str = 'float32', resolution: float = 1.0, seed: int = 0,
+          cache_dir: str = '.build_cache') -> tuple[Data, ScoreStore, nx.Graph, dict[Any, int]]:
+    """Return the Data object, the (read-only, memory-mapped) scores the anime graph is populated from, the anime
+    graph and its partition into clusters, only recomputing the stages whose inputs or parameters have changed since
+    they were cached in cache_dir.
+
+    If the Kaggle files do not exist, the extract stage is skipped and anime_file, genre_file and user_file are used
+    as they are.
+
+    Preconditions:
+        - the Kaggle files exist, or anime_file, genre_file and user_file exist
+        - user_limit > 0
+        - dtype in score_store.QUANTISATION_ERROR
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    file_hashes = _FileHashes(os.path.join(cache_dir, 'file_hashes.json'))
+
+    if os.path.exists(anime_kaggle_file) and os.path.exists(user_kaggle_file):
+        _extract_stage(file_hashes, cache_dir, [anime_kaggle_file, user_kaggle_file],
+                       [anime_file, genre_file, user_file])
+
+    keys = {'data': _hash_values('data', _code_hashes(file_hashes, 'data'),
+                                 [file_hashes.get(f) for f in [anime_file, genre_file, user_file]])}
+    keys['user_genre'] = _hash_values('user_genre', _code_hashes(file_hashes, 'user_genre'), keys['data'])
+    keys['genre_anime'] = _hash_values('genre_anime', _code_hashes(file_hashes, 'genre_anime'), keys['user_genre'])
+    keys['scores'] = _hash_values('scores', _code_hashes(file_hashes, 'scores'), keys['user_genre'],
+                                  keys['genre_anime'], user_limit, dtype)
+    keys['graph'] = _hash_values('graph', _code_hashes(file_hashes, 'graph'), keys['scores'])
+    keys['partition'] = _hash_values('partition', _code_hashes(file_hashes, 'partition'), keys['graph'],
+                                     resolution, seed)
+    file_hashes.save()
+
+    outputs = {}
+
+    def get(stage: str) -> Any:
+        """Return the output of the given stage, loading or computing it the first time it is needed."""
+        if stage not in outputs:
+            if stage == 'scores':
+                # The cached file name is only trusted if the store it names was completely written
+                file_name = _cached(cache_dir, stage, keys[stage], builders[stage], score_store.is_complete)
+                outputs[stage] = score_store.open_score_store(file_name)
+            else:
+                outputs[stage] = _cached(cache_dir, stage, keys[stage], builders[stage])
+        return outputs[stage]
+
+    def build_scores() -> str:
+        """Compute the scores into a memory-mapped file in cache_dir (resuming a build that was killed) and return
+        the name of the file.
+        """
+        file_name = os.path.join(cache_dir, 'scores-' + keys['scores'] + '.bin')
+        data = get('data')
+        matrices.mat_mul_map(get('user_genre'), get('genre_anime'), list(data.anime_to_genre.keys()),
+                             data.user_to_rating, user_limit, dtype, file_name)
+        return file_name
+
+    def build_partition() -> dict[Any, int]:
+        """Divide the graph into clusters and report the modularity of the clusters."""
+        partition = community_detection.best_partition(get('graph'), resolution=resolution, random_state=seed)
+        print('Modularity of the clusters: ' + str(community_detection.modularity(partition, get('graph'),
+                                                                                   resolution)))
+        return partition
+
+    builders = {
+        'data': lambda: Data(anime_file, genre_file, user_file),
+        'user_genre': lambda: matrices.create_user_genre_matrix(get('data')),
+        'genre_anime': lambda: matrices.create_genre_anime_matrix(get('data'), get('user_genre')),
+        'scores': build_scores,
+        'graph': lambda: graph.populate_graph(get('scores')),
+        'partition': build_partition
+    }
+
+    return (get('data'), get('scores'), get('graph'), get('partition'))
+
+
+def _extract_stage(file_hashes: _FileHashes, cache_dir: str, kaggle_files: list[str], csv_files: list[str]) -> None:
+    """Extract the Kaggle files into the csv files, unless they were already extracted from the same Kaggle files
+    and have not changed since.
+    """
+    key = _hash_values('extract', _code_hashes(file_hashes, 'extract'), [file_hashes.get(f) for f in kaggle_files],
+                       csv_files)
+    record = os.path.join(cache_dir, 'extract-' + key + '.json')
+
+    if os.path.exists(record) and all(os.path.exists(f) for f in csv_files):
+        with open(record) as record_file:
+            extracted_hashes = json.load(record_file)
+        if extracted_hashes == [file_hashes.get(f) for f in csv_files]:
+            print('Using cached extract')
+            return
+
+    print('Building extract')
+    extract_raw.extract_data(*kaggle_files, *csv_files)
+
+    with open(record, 'w') as record_file:
+        json.dump([file_hashes.get(f) for f in csv_files], record_file)
+
+    _prune(cache_dir, 'extract', key)
+
+
+def _cached(cache_dir: str, stage: str, key: str, compute: Callable[[], Any],
+            is_valid: Optional[Callable[[Any], bool]] = None) -> Any:
+    """Return the cached output of the given stage for the given key, or compute, cache and return it if there is
+    none (deleting the files cached for the stage under other keys).
+
+    If is_valid is given, a cached output for which it returns False (e.g. one naming a file that has since been
+    deleted) is recomputed.
+    """
+    path = os.path.join(cache_dir, stage + '-' + key + '.pkl')
+
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            output = pickle.load(f)
+        if is_valid is None or is_valid(output):
+            print('Using cached ' + stage)
+            return output
+
+    print('Building ' + stage)
+    output = compute()
+
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(output, f)
+    os.replace(path + '.tmp', path)
+    _prune(cache_dir, stage, key)
+
+    return output
+
+
+def _prune(cache_dir: str, stage: str, key: str) -> None:
+    """Delete the files in cache_dir of the given stage that are not of the given key, i.e. every file named
+    stage-<other key>... (for the scores stage, this includes the scores-<other key>.bin files and their sidecars).
+    """
+    prefix = stage + '-'
+
+    for name in os.listdir(cache_dir):
+        if name.startswith(prefix) and not name.startswith(prefix + key):
+            os.remove(os.path.join(cache_dir, name))
+
+
+def _code_hashes(file_hashes: _FileHashes, stage: str) -> list[str]:
+    """Return the hashes of the source files of the modules run by the given stage."""
+    return [file_hashes.get(module.__file__) for module in _STAGE_MODULES[stage]]
+
+
+def _hash_values(*values: Any) -> str:
+    """Return a hash of the given json-serializable values.
+
+    >>> _hash_values('graph', 'abc') == _hash_values('graph', 'abc') != _hash_values('graph', 'abd')
+    True
+    """
+    return hashlib.sha256(json.dumps(values).encode()).hexdigest()[:16]
+
+
+class _FileHashes:
+    """The content hashes of files, remembered (in a json file) along with the size and modification time of each
+    file so that a file is only read again when it has changed.
+    """
+    _record_file: str
+    _record: dict[str, list]
+    _changed: bool
+
+    def __init__(self, record_file: str) -> None:
+        self._record_file = record_file
+        self._changed = False
+
+        if os.path.exists(record_file):
+            with open(record_file) as f:
+                self._record = json.load(f)
+        else:
+            self._record = {}
+
+    def get(self, file_name: str) -> str:
+        """Return the sha256 hash of the contents of the given file."""
+        path = os.path.abspath(file_name)
+        stat = os.stat(path)
+
+        if path in self._record and self._record[path][:2] == [stat.st_size, stat.st_mtime_ns]:
+            return self._record[path][2]
+
+        file_hash = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                file_hash.update(block)
+
+        self._record[path] = [stat.st_size, stat.st_mtime_ns, file_hash.hexdigest()]
+        self._changed = True
+        return self._record[path][2]
+
+    def save(self) -> None:
+        """Write the remembered hashes to the record file, if any have changed."""
+        if self._changed:
+            with open(self._record_file, 'w') as f:
+                json.dump(self._record, f)
+            self._changed = False
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(verbose=True)
+
+    import python_ta
+    python_ta.check_all(config={
+        'extra-imports': ['networkx', 'hashlib', 'json', 'os', 'pickle', 'data_class', 'calculations',
+                          'community_detection', 'extract_raw', 'graph', 'matrices', 'score_store'],
+        'allowed-io': ['_extract_stage', '_cached', '_FileHashes.__init__', '_FileHashes.get', '_FileHashes.save'],
+        'max-line-length': 120,
+        'disable': ['E9992', 'E9997']
+    })
@@ -0,0 +1,241 @@
+"""
+This Python module contains the BatchQueryExecutor class, which answers many users' anime suggestion requests
+together against one shared anime graph.
+
+This file is Copyright (c) 2023 Anubha Joshi, Lisa Ye, Simran Vig, Iris Li
+
+Notes on batching:
+- requests that arrive within batch_window seconds of the first pending request (up to max_batch_size of them) form
+    a batch
+- every user of a batch is added to its own graph.QueryOverlay over the shared graph and assigned to a cluster of
+    the base partition as in graph.cluster_query_user, so the shared graph is never modified
+- the suggestions of a user are the anime with the highest average rating in their cluster, as in
+    graph.get_avg_weight_map; each cluster's rating totals are summed once from the rows of the scores (the store the
+    graph was populated from) and shared by every user in it
+"""
+from __future__ import annotations
+from concurrent.futures import Future
+from typing import Any
+import queue
+import threading
+import time
+from python_ta.contracts import check_contracts
+import networkx as nx
+import numpy as np
+
+from score_store import ScoreStore
+import community_detection
+import graph
+import score_store
+
+
+# Not decorated with check_contracts: checking the types of every attribute on each call would dominate the time of
+# answering a request, and the checks would read the cluster totals on the submitting thread while the worker thread
+# adds to them
+class BatchQueryExecutor:
+    """
+    A background worker that gathers pending suggestion requests into micro-batches and answers each batch
+    together, sharing the rating totals of each cluster between the users of the batch.
+
+    Instance Attributes:
+    - anime_graph: the graph of users and anime shared by every request
+    - scores: the scores anime_graph was populated from
+    - partition: the partition of the nodes of anime_graph into clusters
+    - anime_list: the anime that may be suggested
+    - batch_window: the number of seconds to wait for more requests after the first request of a batch arrives
+    - max_batch_size: the maximum number of requests in a batch
+
+    Representation Invariants:
+    - self.batch_window >= 0
+    - self.max_batch_size > 0
+    """
+    anime_graph: nx.Graph
+    scores: ScoreStore
+    partition: dict[Any, int]
+    anime_list: list[str]
+    batch_window: float
+    max_batch_size: int
+    _anime_index: dict[str, int]
+    _columns: np.ndarray
+    _totals: np.ndarray
+    _cluster_sums: dict[int, np.ndarray]
+    _cluster_sizes: dict[int, int]
+    _requests: queue.Queue
+    _worker: threading.Thread
+
+    def __init__(self, anime_graph: nx.Graph, scores: ScoreStore, partition: dict[Any, int], anime_list: list[str],
+                 batch_window: float = 0.01, max_batch_size: int = 32) -> None:
+        """Initialize the executor and start its worker thread.
+
+        Preconditions:
+            - anime_graph was returned by graph.populate_graph(scores)
+            - all(node in partition for node in anime_graph.nodes)
+            - all(anime in scores.animes for anime in anime_list)
+            - batch_window >= 0
+            - max_batch_size > 0
+        """
+        self.anime_graph = anime_graph
+        self.scores = scores
+        self.partition = partition
+        self.anime_list = anime_list
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self._anime_index = {anime: i for i, anime in enumerate(anime_list)}
+        store_columns = {anime: i for i, anime in enumerate(scores.animes)}
+        self._columns = np.array([store_columns[anime] for anime in anime_list], dtype=np.int64)
+        self._totals = community_detection.community_degree_totals(anime_graph, partition)
+        self._cluster_sums = {}
+        self._cluster_sizes = {}
+        self._requests = queue.Queue()
+        self._worker = threading.Thread(target=self._serve, daemon=True)
+        self._worker.start()
+
+    def submit(self, preferences: dict[str, float], n: int) -> Future:
+        """Queue a request for n anime suggestions for a user with the given preferences, and return a Future whose
+        result will be the list of suggested anime (from best to least). Preferences for anime that are not in the
+        graph are ignored.
+
+        Preconditions:
+            - n > 0
+        """
+        future = Future()
+        self._requests.put((preferences, n, future))
+        return future
+
+    def close(self) -> None:
+        """Answer the requests that are already queued, then stop the worker thread."""
+        self._requests.put(None)
+        self._worker.join()
+
+    def _serve(self) -> None:
+        """Repeatedly gather a batch of requests and answer it, until close is called."""
+        closing = False
+
+        while not closing:
+            request = self._requests.get()
+            if request is None:
+                return
+
+            batch = [request]
+            deadline = time.monotonic() + self.batch_window
+
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self._requests.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    closing = True
+                    break
+                batch.append(request)
+
+            try:
+                results = self.run_batch([preferences for preferences, _, _ in batch], [n for _, n, _ in batch])
+            except Exception as error:
+                for _, _, future in batch:
+                    future.set_exception(error)
+            else:
+                for (_, _, future), result in zip(batch, results):
+                    future.set_result(result)
+
+    def run_batch(self, batch_preferences: list[dict[str, float]], batch_n: list[int]) -> list[list[str]]:
+        """Return the suggested anime of each user of the batch with the given preferences, where the i-th user wants
+        batch_n[i] suggestions. Preferences for anime that are not in the graph are ignored.
+
+        Preconditions:
+            - len(batch_preferences) == len(batch_n)
+            - all(n > 0 for n in batch_n)
+        """
+        batch_preferences = [{anime: preferences[anime] for anime in preferences if self._is_anime(anime)}
+                             for preferences in batch_preferences]
+        clusters = []
+
+        for preferences in batch_preferences:
+            overlay = graph.QueryOverlay(self.anime_graph, preferences)
+            clusters.extend(community_detection.assign_communities(overlay, self.partition, [overlay.user_name],
+                                                                   self._totals))
+
+        return [self._top_suggestions(cluster, preferences, n)
+                for cluster, preferences, n in zip(clusters, batch_preferences, batch_n)]
+
+    def _is_anime(self, node: Any) -> bool:
+        """Return whether the given node is an anime node of the graph."""
+        return node in self.anime_graph.nodes and self.anime_graph.nodes[node]['type'] == 'anime'
+
+    def _top_suggestions(self, cluster: int, preferences: dict[str, float], n: int) -> list[str]:
+        """Return the n anime with the highest average rating in the given cluster, skipping the user's preferences.
+        """
+        # The user counts towards the cluster size, as in graph.get_avg_weight_map
+        averages = self._cluster_sum(cluster) / (self._cluster_sizes[cluster] + 1)
+
+        candidates = np.ones(len(self.anime_list), dtype=bool)
+        candidates[[self._anime_index[anime] for anime in preferences if anime in self._anime_index]] = False
+
+        ordered = score_store.top_n_indices(averages, n, candidates)
+        return [self.anime_list[i] for i in ordered]
+
+    def _cluster_sum(self, cluster: int) -> np.ndarray:
+        """Return the total rating of each anime in self.anime_list by the users in the given cluster, computing it
+        the first time the cluster is needed.
+        """
+        if cluster not in self._cluster_sums:
+            users = [user for user in self.scores.users if self.partition[user] == cluster]
+
+            self._cluster_sums[cluster] = self.scores.sum_rows(users)[self._columns]
+            self._cluster_sizes[cluster] = len(users)
+
+        return self._cluster_sums[cluster]
+
+
+@check_contracts
+def benchmark_batch_sizes(anime_graph: nx.Graph, scores: ScoreStore, partition: dict[Any, int], anime_list: list[str],
+                          requests: list[tuple[dict[str, float], int]], batch_sizes: list[int],
+                          batch_window: float = 0.01) -> dict[int, tuple[float, float]]:
+    """Return a dictionary mapping each of the given maximum batch sizes to the throughput (requests per second) and
+    the mean latency (seconds from submitting a request to its result) of answering all the given
+    (preferences, number of suggestions) requests, submitted at once, with a fresh executor.
+
+    Preconditions:
+        - requests != []
+        - all(size > 0 for size in batch_sizes)
+    """
+    results = {}
+
+    for size in batch_sizes:
+        executor = BatchQueryExecutor(anime_graph, scores, partition, anime_list, batch_window, size)
+        latencies = []
+
+        start = time.perf_counter()
+        for preferences, n in requests:
+            submitted = time.perf_counter()
+            future = executor.submit(preferences, n)
+            future.add_done_callback(lambda _, submitted=submitted: latencies.append(time.perf_counter() - submitted))
+        executor.close()
+        elapsed = time.perf_counter() - start
+
+        results[size] = (len(requests) / elapsed, sum(latencies) / len(latencies))
+
+    return results
+
+
+def print_benchmark(results: dict[int, tuple[float, float]]) -> None:
+    """Print the results of benchmark_batch_sizes as a table."""
+    print('batch size | requests/s | mean latency (ms)')
+    for size in results:
+        throughput, latency = results[size]
+        print(str(size).rjust(10) + ' | ' + str(round(throughput, 1)).rjust(10) + ' | ' +
+              str(round(latency * 1000, 2)).rjust(17))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(verbose=True)
+
+    import python_ta
+    python_ta.check_all(config={
+        'extra-imports': ['numpy', 'networkx', 'concurrent.futures', 'queue', 'threading', 'time',
+                          'score_store', 'community_detection', 'graph'],
+        'allowed-io': ['print_benchmark'],
+        'max-line-length': 120,
+        'disable': ['E9992', 'E9997']
+    })
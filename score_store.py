@@ -0,0 +1,373 @@
+"""
+This Python module contains the ScoreStore class, a compact matrix of the actual and predicted anime ratings of
+each user.
+
+This file is Copyright (c) 2023 Anubha Joshi, Lisa Ye, Simran Vig, Iris Li
+
+Notes on storage:
+- every score lies in [0.0, 1.0], so scores are either kept as float32 or quantised to a uint8 or uint16 code
+    (code = round(score * max_code)), which bounds the absolute error of every stored score by QUANTISATION_ERROR
+- a separate bitmap (one bit per cell, packed eight to a byte) marks which scores are real ratings rather than
+    predictions
+- a store may be backed by files on disk, in which case the scores are memory-mapped from file_name, the bitmap from
+    file_name + '.rated', and the users, animes, dtype, inputs hash and progress checkpoint are kept in
+    file_name + '.json'
+"""
+from __future__ import annotations
+from typing import Optional
+import json
+import os
+from python_ta.contracts import check_contracts
+import numpy as np
+
+# The maximum absolute error between a score and the score read back from the store, for each storage dtype (the
+# 2 ** -52 covers the float64 rounding of encoding and decoding a code)
+QUANTISATION_ERROR = {
+    'float32': 2.0 ** -25,
+    'uint16': 1 / (2 * 65535) + 2.0 ** -52,
+    'uint8': 1 / (2 * 255) + 2.0 ** -52
+}
+
+
+@check_contracts
+class ScoreStore:
+    """
+    A dense users x animes matrix of scores in [0.0, 1.0], along with a bitmap marking which scores are the user's
+    actual rating of the anime.
+
+    Instance Attributes:
+    - users: the usernames corresponding to the rows of the matrix, in order
+    - animes: the anime titles corresponding to the columns of the matrix, in order
+    - dtype: the name of the numpy dtype the scores are stored as
+    - file_name: the file the scores are memory-mapped from, or None if the store is kept in memory
+    - inputs_hash: a hash of the inputs the scores are computed from (or '' if not given), so that files computed
+    from other inputs are not resumed
+    - rows_done: the number of leading rows that have been completely written (the build checkpoint)
+
+    Representation Invariants:
+    - self.dtype in QUANTISATION_ERROR
+    - len(set(self.users)) == len(self.users)
+    - len(set(self.animes)) == len(self.animes)
+    - 0 <= self.rows_done <= len(self.users)
+    """
+    users: list[str]
+    animes: list[str]
+    dtype: str
+    file_name: Optional[str]
+    inputs_hash: str
+    rows_done: int
+    _user_index: dict[str, int]
+    _anime_index: dict[str, int]
+    _scores: np.ndarray
+    _rated: np.ndarray
+
+    def __init__(self, users: list[str], animes: list[str], dtype: str = 'float32',
+                 file_name: Optional[str] = None, read_only: bool = False, inputs_hash: str = '') -> None:
+        """Initializes the store for the given users and animes.
+
+        If file_name is None, the store is kept in memory with every score 0.0 and not rated. Otherwise, the store
+        is memory-mapped from file_name: if the files there were created for the same users, animes, dtype and
+        inputs_hash, they are reopened (keeping their rows_done checkpoint), and if not, they are created empty.
+
+        Preconditions:
+            - dtype in QUANTISATION_ERROR
+            - not read_only or file_name is not None
+            - not read_only or the files at file_name were created for the same users, animes, dtype and inputs_hash
+        """
+        self.users = users
+        self.animes = animes
+        self.dtype = dtype
+        self.file_name = file_name
+        self.inputs_hash = inputs_hash
+        self._user_index = {user: i for i, user in enumerate(users)}
+        self._anime_index = {anime: i for i, anime in enumerate(animes)}
+
+        scores_shape = (len(users), len(animes))
+        rated_shape = (len(users), (len(animes) + 7) // 8)
+
+        if file_name is None or len(users) == 0 or len(animes) == 0:
+            self._scores = np.zeros(scores_shape, dtype=dtype)
+            self._rated = np.zeros(rated_shape, dtype=np.uint8)
+            self.rows_done = 0
+            return
+
+        metadata = _read_metadata(file_name)
+        resume = metadata is not None and metadata['users'] == users and metadata['animes'] == animes \
+            and metadata['dtype'] == dtype and metadata.get('inputs_hash', '') == inputs_hash
+
+        if read_only:
+            mode = 'r'
+        elif resume:
+            mode = 'r+'
+        else:
+            mode = 'w+'
+
+        self._scores = np.memmap(file_name, dtype=dtype, mode=mode, shape=scores_shape)
+        self._rated = np.memmap(file_name + '.rated', dtype=np.uint8, mode=mode, shape=rated_shape)
+
+        if resume:
+            self.rows_done = metadata['rows_done']
+        else:
+            self.rows_done = 0
+            self.checkpoint(0)
+
+    def set_row(self, user: str, scores: np.ndarray, rated: np.ndarray) -> None:
+        """Store the scores of the given user for every anime, where rated[i] is whether scores[i] is the user's
+        actual rating of self.animes[i].
+
+        Preconditions:
+            - user in self.users
+            - scores.shape == rated.shape == (len(self.animes),)
+            - all(0.0 <= score <= 1.0 for score in scores)
+        """
+        row = self._user_index[user]
+        self._scores[row] = encode_scores(scores, self.dtype)
+        self._rated[row] = np.packbits(rated)
+
+    def set_rows(self, start: int, scores: np.ndarray, rated: np.ndarray) -> None:
+        """Store a block of consecutive rows starting at row start, where scores and rated are
+        (number of rows) x len(self.animes) arrays as described in set_row.
+
+        Preconditions:
+            - 0 <= start and start + scores.shape[0] <= len(self.users)
+            - scores.shape == rated.shape and scores.shape[1] == len(self.animes)
+            - all(0.0 <= score <= 1.0 for score in scores.flat)
+        """
+        end = start + scores.shape[0]
+        self._scores[start:end] = encode_scores(scores, self.dtype)
+        self._rated[start:end] = np.packbits(rated, axis=1)
+
+    def checkpoint(self, rows_done: int) -> None:
+        """Record that the first rows_done rows have been completely written.
+
+        For a store backed by files, the scores and bitmap are flushed to disk before the checkpoint is written, so
+        a build that is killed can resume from the last checkpoint.
+
+        Preconditions:
+            - 0 <= rows_done <= len(self.users)
+        """
+        self.rows_done = rows_done
+
+        if isinstance(self._scores, np.memmap):
+            self._scores.flush()
+            self._rated.flush()
+            _write_metadata(self.file_name, {'users': self.users, 'animes': self.animes, 'dtype': self.dtype,
+                                             'inputs_hash': self.inputs_hash, 'rows_done': rows_done})
+
+    def get_row(self, user: str) -> np.ndarray:
+        """Return the scores of the given user for every anime, in the order of self.animes (decoded as by
+        decode_scores).
+
+        Preconditions:
+            - user in self.users
+        """
+        return decode_scores(self._scores[self._user_index[user]], self.dtype)
+
+    def get_rated_row(self, user: str) -> np.ndarray:
+        """Return a boolean array marking which of the given user's scores are actual ratings.
+
+        Preconditions:
+            - user in self.users
+        """
+        return np.unpackbits(self._rated[self._user_index[user]], count=len(self.animes)).astype(bool)
+
+    def get_score(self, user: str, anime: str) -> float:
+        """Return the score of the given user for the given anime.
+
+        Preconditions:
+            - user in self.users
+            - anime in self.animes
+
+        >>> store = ScoreStore(['Bob'], ['AOT', 'FMAB'], 'uint8')
+        >>> store.set_row('Bob', np.array([0.3, 1.0]), np.array([True, False]))
+        >>> abs(store.get_score('Bob', 'AOT') - 0.3) <= QUANTISATION_ERROR['uint8']
+        True
+        """
+        code = self._scores[self._user_index[user], self._anime_index[anime]]
+        return float(decode_scores(code, self.dtype))
+
+    def is_rated(self, user: str, anime: str) -> bool:
+        """Return whether the score of the given user for the given anime is the user's actual rating.
+
+        Preconditions:
+            - user in self.users
+            - anime in self.animes
+
+        >>> store = ScoreStore(['Bob'], ['AOT', 'FMAB'])
+        >>> store.set_row('Bob', np.array([0.3, 0.6]), np.array([True, False]))
+        >>> store.is_rated('Bob', 'AOT'), store.is_rated('Bob', 'FMAB')
+        (True, False)
+        """
+        column = self._anime_index[anime]
+        byte = self._rated[self._user_index[user], column >> 3]
+        return bool((byte >> (7 - (column & 7))) & 1)
+
+    def get_user_scores(self, user: str) -> dict[str, float]:
+        """Return a dictionary mapping of each anime title to the given user's score for it.
+
+        Preconditions:
+            - user in self.users
+        """
+        return dict(zip(self.animes, self.get_row(user).tolist()))
+
+    def get_column(self, anime: str) -> np.ndarray:
+        """Return the scores of every user for the given anime, in the order of self.users (decoded as by
+        decode_scores).
+
+        Preconditions:
+            - anime in self.animes
+        """
+        return decode_scores(self._scores[:, self._anime_index[anime]], self.dtype)
+
+    def top_n(self, user: str, n: int, anime_mask: Optional[np.ndarray] = None) -> list[str]:
+        """Return a list of the (at most) n anime titles with the highest predicted score for the given user (in order
+        from best to least), skipping the anime the user has actually rated.
+
+        If anime_mask is given, only the anime marked in it are considered (e.g. a mask from Data.anime_filter for
+        genre-filtered suggestions).
+
+        Preconditions:
+            - user in self.users
+            - n > 0
+            - anime_mask is None or anime_mask.shape == (len(self.animes),)
+
+        >>> store = ScoreStore(['Bob'], ['AOT', 'FMAB', 'MP100'])
+        >>> store.set_row('Bob', np.array([0.9, 0.4, 0.7]), np.array([True, False, False]))
+        >>> store.top_n('Bob', 5)
+        ['MP100', 'FMAB']
+        >>> store.top_n('Bob', 5, np.array([True, True, False]))
+        ['FMAB']
+        """
+        selected = ~self.get_rated_row(user)
+        if anime_mask is not None:
+            selected &= anime_mask
+
+        return [self.animes[i] for i in top_n_indices(self.get_row(user), n, selected)]
+
+    def sum_rows(self, users: list[str], block_size: int = 256) -> np.ndarray:
+        """Return the total score of the given users for every anime, in the order of self.animes.
+
+        The users' rows are read from the store (and decoded as by decode_scores) block_size rows at a time, so
+        only one block of rows is in memory at once.
+
+        Preconditions:
+            - set(users) <= set(self.users)
+            - block_size > 0
+
+        >>> store = ScoreStore(['Bob', 'Ann'], ['AOT', 'FMAB'])
+        >>> store.set_row('Bob', np.array([0.25, 0.5]), np.array([True, False]))
+        >>> store.set_row('Ann', np.array([0.5, 0.25]), np.array([False, False]))
+        >>> store.sum_rows(['Bob', 'Ann']).tolist()
+        [0.75, 0.75]
+        """
+        rows = np.sort(np.array([self._user_index[user] for user in users], dtype=np.int64))
+        total = np.zeros(len(self.animes))
+
+        for start in range(0, len(rows), block_size):
+            block = decode_scores(self._scores[rows[start:start + block_size]], self.dtype)
+            total += block.sum(axis=0, dtype=np.float64)
+
+        return total
+
+    def nbytes(self) -> int:
+        """Return the number of bytes used by the scores and the rated bitmap."""
+        return self._scores.nbytes + self._rated.nbytes
+
+
+def open_score_store(file_name: str) -> ScoreStore:
+    """Return a read-only ScoreStore memory-mapped from the files at file_name. Rows are only read from disk
+    when they are accessed.
+
+    Preconditions:
+        - file_name was the file_name of a ScoreStore that has been checkpointed
+    """
+    metadata = _read_metadata(file_name)
+    return ScoreStore(metadata['users'], metadata['animes'], metadata['dtype'], file_name, read_only=True,
+                      inputs_hash=metadata.get('inputs_hash', ''))
+
+
+def is_complete(file_name: str) -> bool:
+    """Return whether the files at file_name (the scores, the rated bitmap and the metadata) exist and every row of
+    the store backed by them has been written and checkpointed.
+
+    >>> is_complete('no-such-store.bin')
+    False
+    """
+    metadata = _read_metadata(file_name)
+    return metadata is not None and os.path.exists(file_name + '.rated') \
+        and metadata['rows_done'] == len(metadata['users'])
+
+
+def _read_metadata(file_name: str) -> Optional[dict]:
+    """Return the metadata of the store backed by file_name, or None if there is none."""
+    if not os.path.exists(file_name + '.json') or not os.path.exists(file_name):
+        return None
+
+    with open(file_name + '.json') as f:
+        return json.load(f)
+
+
+def _write_metadata(file_name: str, metadata: dict) -> None:
+    """Replace the metadata of the store backed by file_name with the given metadata."""
+    with open(file_name + '.json.tmp', 'w') as f:
+        json.dump(metadata, f)
+
+    os.replace(file_name + '.json.tmp', file_name + '.json')
+
+
+def encode_scores(scores: np.ndarray, dtype: str) -> np.ndarray:
+    """Return the given scores in [0.0, 1.0] converted to the given storage dtype.
+
+    >>> encode_scores(np.array([0.0, 0.5, 1.0]), 'uint8').tolist()
+    [0, 128, 255]
+    """
+    if dtype == 'float32':
+        return np.asarray(scores, dtype=np.float32)
+
+    max_code = np.iinfo(dtype).max
+    return np.rint(np.clip(scores, 0.0, 1.0) * max_code).astype(dtype)
+
+
+def top_n_indices(scores: np.ndarray, n: int, selected: np.ndarray) -> np.ndarray:
+    """Return the indices of the (at most) n highest of the given scores that are marked in selected, in order from
+    the highest score to the lowest (ties in order of index).
+
+    Only the top n are sorted, so this takes O(len(scores) + n log n) time.
+
+    >>> top_n_indices(np.array([0.2, 0.9, 0.5, 0.7]), 2, np.array([True, False, True, True])).tolist()
+    [3, 2]
+    """
+    candidates = np.flatnonzero(selected)
+
+    if n < len(candidates):
+        candidates = candidates[np.argpartition(-scores[candidates], n - 1)[:n]]
+        candidates.sort()
+
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+def decode_scores(codes: np.ndarray, dtype: str) -> np.ndarray:
+    """Return the scores corresponding to the given codes of the given storage dtype, as float32 scores for the
+    float32 dtype and float64 scores otherwise (decoding a code in float32 would add float32 rounding error to the
+    quantisation error).
+
+    >>> decode_scores(np.array([0, 255], dtype=np.uint8), 'uint8').tolist()
+    [0.0, 1.0]
+    """
+    if dtype == 'float32':
+        return np.asarray(codes, dtype=np.float32)
+
+    return np.asarray(codes, dtype=np.float64) / np.iinfo(dtype).max
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(verbose=True)
+
+    import python_ta
+    python_ta.check_all(config={
+        'extra-imports': ['numpy', 'json', 'os'],
+        'allowed-io': ['_read_metadata', '_write_metadata'],
+        'max-line-length': 120,
+        'disable': ['E9992', 'E9997']
+    })